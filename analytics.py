@@ -0,0 +1,258 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+
+from timeseries import FIELDS, HEADER
+
+# Same layout as timeseries.RECORD, so a store can be read in one go
+RECORD_DTYPE = np.dtype([("ordinal", "<u4"), ("fields", "<i8", (FIELDS,))])
+
+# metric is one of the Analytics columns; crossing threshold (upwards) alerts
+Trigger = namedtuple("Trigger", ["name", "metric", "threshold"])
+TRIGGERS = [
+    # NYS moves a campus to remote learning at 100 positives in 14 days
+    Trigger("NYS pause (100 positives in 14 days)", "rolling14", 100),
+    Trigger("Weekly positivity at 5%", "positivity", 5.0),
+]
+
+DayStats = namedtuple(
+    "DayStats", ["date", "daily", "rolling7", "rolling14", "positivity", "growth"]
+)
+
+
+class Analytics:
+    """
+    Per-day metrics over the whole history, as dense NumPy columns indexed by
+    day (days without a record count as 0 new positives and carry the
+    previous weekly numbers forward):
+
+    daily       new positive tests
+    rolling7    positives over the last 7 days
+    rolling14   positives over the last 14 days
+    positivity  weekly positive results / weekly tests, in percent
+    growth      week over week change of rolling7, in percent
+
+    Everything is computed in one vectorized pass, then kept up to date by
+    append() as new days come in.
+    """
+
+    def __init__(self, ordinals=(), fields=(), triggers=TRIGGERS):
+        self.triggers = triggers
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        fields = np.asarray(fields, dtype=np.int64).reshape(-1, FIELDS)
+        self.start = None if len(ordinals) == 0 else int(ordinals[0])
+        self.size = 0
+        self._columns = {}
+        self._reserve(0 if self.start is None else int(ordinals[-1]) - self.start + 1)
+        if self.start is None:
+            return
+
+        index = ordinals - self.start
+        self.size = int(index[-1]) + 1
+        # Carry each record forward over the days without one
+        latest = np.full(self.size, -1)
+        latest[index] = np.arange(len(index))
+        latest = np.maximum.accumulate(latest)
+        self._columns["daily"][index] = fields[:, 0]
+        self._columns["weekly_positives"][: self.size] = fields[latest, 1]
+        self._columns["weekly_tests"][: self.size] = fields[latest, 3]
+        self._derive(0, self.size)
+
+    @classmethod
+    def from_store(cls, store, triggers=TRIGGERS):
+        # Straight off the store's mmap, no per-record Python work
+        records = np.frombuffer(
+            store._view(), RECORD_DTYPE, len(store), HEADER.size
+        ).copy()
+        return cls(records["ordinal"], records["fields"], triggers)
+
+    @classmethod
+    def from_history(cls, history, triggers=TRIGGERS):
+        days = sorted(history)
+        return cls(
+            [day.toordinal() for day in days],
+            [(list(history[day]) + [0] * FIELDS)[:FIELDS] for day in days],
+            triggers,
+        )
+
+    def _reserve(self, size):
+        # Columns grow by doubling so append() is amortized O(1)
+        capacity = len(self._columns.get("daily", ()))
+        if size <= capacity and self._columns:
+            return
+        capacity = max(size, capacity * 2, 64)
+        for name, dtype in [
+            ("daily", np.int64),
+            ("weekly_positives", np.int64),
+            ("weekly_tests", np.int64),
+            ("rolling7", np.int64),
+            ("rolling14", np.int64),
+            ("positivity", np.float64),
+            ("growth", np.float64),
+        ]:
+            column = np.zeros(capacity, dtype=dtype)
+            old = self._columns.get(name)
+            if old is not None:
+                column[: len(old)] = old
+            self._columns[name] = column
+        prefix = np.zeros(capacity + 1, dtype=np.int64)
+        old = self._columns.get("prefix")
+        if old is not None:
+            prefix[: len(old)] = old
+        # prefix[i] = sum(daily[:i])
+        self._columns["prefix"] = prefix
+
+    def _derive(self, low, high):
+        # Recomputes the derived columns for days low..high-1; everything they
+        # depend on (the prefix sums before low, rolling7 a week back) is current
+        c = self._columns
+        c["prefix"][low + 1 : high + 1] = c["prefix"][low] + np.cumsum(
+            c["daily"][low:high]
+        )
+        days = np.arange(low, high)
+        for name, window in [("rolling7", 7), ("rolling14", 14)]:
+            c[name][low:high] = (
+                c["prefix"][days + 1] - c["prefix"][np.maximum(days + 1 - window, 0)]
+            )
+
+        tests = c["weekly_tests"][low:high]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            c["positivity"][low:high] = np.where(
+                tests > 0, c["weekly_positives"][low:high] / tests * 100, np.nan
+            )
+            previous = np.where(days >= 7, c["rolling7"][np.maximum(days - 7, 0)], 0)
+            c["growth"][low:high] = np.where(
+                previous > 0, (c["rolling7"][low:high] / previous - 1) * 100, np.nan
+            )
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        # One column, covering the first recorded day through the last
+        return self._columns[name][: self.size]
+
+    def _index(self, day):
+        return day.toordinal() - self.start
+
+    def append(self, day, case_data):
+        """
+        Adds (or re-records) the latest day and recomputes only that tail.
+        Like TimeSeriesStore.append(), older days need a rebuild.
+        """
+
+        if self.start is None:
+            self.__init__([day.toordinal()], [case_data], self.triggers)
+            return
+        index = self._index(day)
+        if index < self.size - 1:
+            raise ValueError(f"Cannot append {day}, analytics already end later")
+
+        self._reserve(index + 1)
+        c = self._columns
+        low = min(self.size, index)
+        # Days skipped since the last record: nothing new, weekly numbers carried
+        c["daily"][low:index] = 0
+        c["weekly_positives"][low:index] = c["weekly_positives"][self.size - 1]
+        c["weekly_tests"][low:index] = c["weekly_tests"][self.size - 1]
+        c["daily"][index] = case_data[0]
+        c["weekly_positives"][index] = case_data[1]
+        c["weekly_tests"][index] = case_data[3]
+        self.size = index + 1
+        self._derive(low, self.size)
+
+    def _prefix_at(self, index):
+        # Sum of daily[:index], clamped to the recorded span
+        return self._columns["prefix"][np.clip(index, 0, self.size)]
+
+    def window_sums(self, start, end, days=14):
+        # Rolling `days`-long sums ending on every day from start through end
+        count = (end - start).days + 1
+        if self.start is None or count <= 0:
+            return [0] * max(count, 0)
+        ends = np.arange(count) + self._index(start) + 1
+        return (self._prefix_at(ends) - self._prefix_at(ends - days)).tolist()
+
+    def window_sum(self, end, days=14):
+        # window_sums() for a single day, without building arrays
+        if self.start is None:
+            return 0
+        index = self._index(end) + 1
+        high = min(max(index, 0), self.size)
+        low = min(max(index - days, 0), self.size)
+        prefix = self._columns["prefix"]
+        return int(prefix[high]) - int(prefix[low])
+
+    def daily_values(self, start, end):
+        # New positives for every day from start through end (0 outside the history)
+        count = (end - start).days + 1
+        if self.start is None or count <= 0:
+            return [0] * max(count, 0)
+        first = self._index(start)
+        lead = min(max(-first, 0), count)
+        values = self["daily"][max(first, 0) : max(first + count, 0)].tolist()
+        return [0] * lead + values + [0] * (count - lead - len(values))
+
+    def cumulative(self, start, end):
+        # Positives since start, as of every day from start through end
+        count = (end - start).days + 1
+        if self.start is None or count <= 0:
+            return [0] * max(count, 0)
+        first = self._index(start)
+        ends = np.arange(count) + first + 1
+        return (self._prefix_at(ends) - self._prefix_at(first)).tolist()
+
+    def at(self, day):
+        if self.start is None or not 0 <= self._index(day) < self.size:
+            return None
+        index = self._index(day)
+        value = lambda name: self._columns[name][index].item()
+        nan_to_none = lambda x: None if x != x else x
+        return DayStats(
+            day,
+            value("daily"),
+            value("rolling7"),
+            value("rolling14"),
+            nan_to_none(value("positivity")),
+            nan_to_none(value("growth")),
+        )
+
+    def crossings(self, trigger):
+        """
+        Every day the trigger's metric crossed its threshold, as
+        [(date, True if it went above / False if it dropped back below)].
+        """
+
+        above = np.nan_to_num(self[trigger.metric], nan=-np.inf) >= trigger.threshold
+        changes = np.flatnonzero(above[1:] != above[:-1]) + 1
+        if len(above) > 0 and above[0]:
+            changes = np.concatenate([[0], changes])
+        return [
+            (date.fromordinal(self.start + int(i)), bool(above[i])) for i in changes
+        ]
+
+    def alerts(self, day):
+        # Triggers whose threshold was crossed on day, with the direction
+        index = None if self.start is None else self._index(day)
+        if index is None or not 0 <= index < self.size:
+            return []
+        alerts = []
+        for trigger in self.triggers:
+            # Only today and the day before matter; NaN never counts as above
+            column = self._columns[trigger.metric]
+            now = bool(column[index] >= trigger.threshold)
+            before = index > 0 and bool(column[index - 1] >= trigger.threshold)
+            if now != before:
+                alerts.append((trigger, now))
+        return alerts
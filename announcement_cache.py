@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+
+CACHE_PATH = ".cache_announcements"
+LEGACY_CACHE_PATH = ".cache_sample"
+# SQLite caps the number of bound parameters per statement
+BATCH_SIZE = 500
+
+
+def read_legacy_paths(path):
+    # The old line file has at least one corrupted entry ("* /announcements/..."),
+    # so keep just the /path part of each line
+    paths = []
+    with open(path, "r") as f:
+        for line in f:
+            start = line.find("/")
+            if start != -1:
+                paths.append(line[start:].strip())
+    return paths
+
+
+class AnnouncementCache:
+    """
+    SQLite-backed set of announcement paths that have already been handled.
+    Membership checks are primary key lookups, and mark_seen() commits a whole
+    batch in one transaction so an interrupted run marks nothing.
+
+    It also remembers each page's HTTP validators and content fingerprint.
+    Those are staged with stage_page() and only written by the next
+    mark_seen(), alongside the paths they belong to.
+    """
+
+    def __init__(self, path=CACHE_PATH, legacy_path=LEGACY_CACHE_PATH):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages "
+            "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, fingerprint TEXT)"
+        )
+        self.staged = {}
+        self.staged_lock = threading.Lock()
+        empty = self.db.execute("SELECT 1 FROM seen LIMIT 1").fetchone() is None
+        if empty and legacy_path is not None and os.path.exists(legacy_path):
+            self.mark_seen(read_legacy_paths(legacy_path))
+
+    def __contains__(self, path):
+        query = "SELECT 1 FROM seen WHERE path = ?"
+        return self.db.execute(query, (path,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def seen(self, paths):
+        # Which of paths are already in the cache, in one query per batch
+        found = set()
+        for i in range(0, len(paths), BATCH_SIZE):
+            batch = paths[i : i + BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            query = f"SELECT path FROM seen WHERE path IN ({placeholders})"
+            found.update(row[0] for row in self.db.execute(query, batch))
+        return found
+
+    def filter_new(self, paths):
+        seen = self.seen(paths)
+        return [path for path in paths if path not in seen]
+
+    def recent(self, count):
+        # The count paths marked seen last, most recent first
+        query = "SELECT path FROM seen ORDER BY rowid DESC LIMIT ?"
+        return [row[0] for row in self.db.execute(query, (count,))]
+
+    def page(self, url):
+        # (etag, last_modified, fingerprint) from the last committed fetch, or None
+        query = "SELECT etag, last_modified, fingerprint FROM pages WHERE url = ?"
+        return self.db.execute(query, (url,)).fetchone()
+
+    def stage_page(self, url, etag, last_modified, fingerprint):
+        with self.staged_lock:
+            self.staged[url] = (etag, last_modified, fingerprint)
+
+    def unstage(self, urls):
+        # Drops staged pages, so the next crawl fetches and handles them again
+        with self.staged_lock:
+            for url in urls:
+                self.staged.pop(url, None)
+
+    def mark_seen(self, paths):
+        with self.staged_lock:
+            staged, self.staged = self.staged, {}
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO seen (path) VALUES (?)",
+                ((path,) for path in paths),
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                ((url, *page) for url, page in staged.items()),
+            )
+
+    def close(self):
+        self.db.close()
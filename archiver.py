@@ -0,0 +1,196 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import threading
+import time
+import traceback
+
+import metrics
+from state import atomic_write
+
+ARCHIVE_QUEUE = ".cache_archive"
+# Seconds to give one capture before treating it as failed
+CAPTURE_TIMEOUT = 120
+MAX_ATTEMPTS = 5
+
+
+def savepagenow_capture(url):
+    import savepagenow
+
+    return savepagenow.capture(url, accept_cache=True)
+
+
+def call_with_timeout(func, timeout, *args):
+    # Runs func on a daemon thread so a hung capture can't keep the process alive
+    result = {}
+
+    def target():
+        try:
+            result["value"] = func(*args)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"{func.__name__} took longer than {timeout}s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+class ArchiveQueue:
+    """
+    Wayback Machine capture jobs, persisted to disk so unfinished ones carry
+    over to the next run. Jobs are keyed by a hash of the page content: the
+    same content is only captured once, and every Discord message that linked
+    it gets updated when the capture lands.
+    """
+
+    def __init__(self, path=ARCHIVE_QUEUE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as file:
+                state = json.load(file)
+        except:
+            state = {}
+        self.jobs = state.get("jobs", {})
+        self.captures = state.get("captures", {})
+
+    def save(self):
+        with self.lock:
+            atomic_write(
+                self.path, json.dumps({"jobs": self.jobs, "captures": self.captures})
+            )
+
+    def archived_url(self, content_hash):
+        return self.captures.get(content_hash)
+
+    def enqueue(self, url, content_hash, messages=()):
+        """
+        Queues a capture of url. messages are (webhook url, message id,
+        content) tuples to edit once the capture exists.
+        """
+
+        with self.lock:
+            job = self.jobs.setdefault(
+                content_hash,
+                {"url": url, "attempts": 0, "messages": [], "created": time.time()},
+            )
+            job["messages"].extend(list(message) for message in messages)
+        self.save()
+
+    def pending(self):
+        with self.lock:
+            return [
+                (content_hash, dict(job))
+                for content_hash, job in self.jobs.items()
+                if job["attempts"] < MAX_ATTEMPTS
+            ]
+
+    def run_pending(
+        self,
+        capture=None,
+        follow_up=None,
+        timeout=CAPTURE_TIMEOUT,
+        retries=2,
+        backoff=10,
+    ):
+        """
+        Attempts every pending capture, including ones queued while this runs.
+        Each job gets retries extra tries (with exponential backoff) before
+        it is left for a later run; MAX_ATTEMPTS bounds the total. On success
+        the archive URL is recorded and follow_up(archive_url, messages) is
+        called to update the posts that linked the live page.
+        """
+
+        capture = savepagenow_capture if capture is None else capture
+        tried = set()
+        while True:
+            jobs = [job for job in self.pending() if job[0] not in tried]
+            if not jobs:
+                return
+            for content_hash, job in jobs:
+                tried.add(content_hash)
+                archive_url = self.attempt(
+                    content_hash, job, capture, timeout, retries, backoff
+                )
+                if archive_url is None:
+                    continue
+                with self.lock:
+                    self.captures[content_hash] = archive_url
+                    # Messages may have been attached while the capture ran
+                    job = self.jobs.pop(content_hash)
+                self.save()
+                print(f"Archived {job['url']} as {archive_url}")
+                if follow_up is not None and job["messages"]:
+                    try:
+                        follow_up(archive_url, job["messages"])
+                    except:
+                        print("Updating Discord messages with the archive link failed")
+                        traceback.print_exc()
+
+    def attempt(self, content_hash, job, capture, timeout, retries, backoff):
+        for retry in range(retries + 1):
+            if job["attempts"] >= MAX_ATTEMPTS:
+                break
+            if retry > 0:
+                time.sleep(backoff * 2 ** (retry - 1))
+            try:
+                with metrics.span("archive"):
+                    return call_with_timeout(capture, timeout, job["url"])
+            except:
+                metrics.count("archive_failures")
+                job["attempts"] += 1
+                print(f"Page archive failed (attempt {job['attempts']})")
+                traceback.print_exc()
+                with self.lock:
+                    self.jobs[content_hash]["attempts"] = job["attempts"]
+                self.save()
+        return None
+
+
+_queue = None
+_worker = None
+# Guards _queue and _worker, multisite.py publishes from several threads at once
+_lock = threading.Lock()
+
+
+def get_queue(path=ARCHIVE_QUEUE):
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = ArchiveQueue(path)
+        return _queue
+
+
+def start_background(queue, capture=None, follow_up=None, timeout=CAPTURE_TIMEOUT):
+    """
+    Runs queue.run_pending() on a background thread. A worker that is still
+    running picks up newly queued jobs itself, so it is reused.
+    """
+
+    global _worker
+    with _lock:
+        if _worker is not None and _worker.is_alive():
+            return _worker
+        _worker = threading.Thread(
+            target=queue.run_pending, args=(capture, follow_up, timeout), daemon=True
+        )
+        _worker.start()
+        return _worker
+
+
+def wait_for_background(timeout=None):
+    if _worker is not None:
+        _worker.join(timeout)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Usage: ./backfill.py [--from YYYYMMDD] [--to YYYYMMDD] [--workers N]
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import argparse
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from main import (
+    DASHBOARD,
+    extract_stats_block,
+    load_previous,
+    parse_dashboard,
+    parse_dashboard_stream,
+    save,
+)
+from state import atomic_write
+from webhooks import HostRateLimiter, create_session, fetch
+
+WAYBACK = "https://web.archive.org"
+BACKFILL_CACHE = ".cache_wayback"
+CDX_PAGE_SIZE = 1000
+
+
+def list_snapshots(session, limiter, start=None, end=None, wayback=WAYBACK):
+    """
+    Enumerates archived dashboard captures through the CDX API, following
+    resume keys page by page. Captures with identical content (same digest)
+    are collapsed by the API. Returns [(timestamp, original url)] oldest first.
+    """
+
+    params = {
+        "url": DASHBOARD.split("://", 1)[1],
+        "output": "json",
+        "fl": "timestamp,original",
+        "filter": "statuscode:200",
+        "collapse": "digest",
+        "limit": CDX_PAGE_SIZE,
+        "showResumeKey": "true",
+    }
+    if start is not None:
+        params["from"] = start
+    if end is not None:
+        params["to"] = end
+
+    snapshots = []
+    while True:
+        url = f"{wayback}/cdx/search/cdx"
+        query = "&".join(f"{key}={value}" for key, value in params.items())
+        rows = fetch(f"{url}?{query}", session, limiter).json()
+        # First row is the field names; a resume key follows an empty row
+        resume_key = None
+        if len(rows) >= 2 and rows[-2] == []:
+            resume_key = rows[-1][0]
+            rows = rows[:-2]
+        snapshots.extend((row[0], row[1]) for row in rows[1:])
+        if resume_key is None:
+            return snapshots
+        params["resumeKey"] = resume_key
+
+
+def snapshot_path(timestamp, cache_dir=BACKFILL_CACHE):
+    return os.path.join(cache_dir, f"{timestamp}.html")
+
+
+def fetch_snapshot(session, limiter, timestamp, original, wayback=WAYBACK):
+    # Cached on disk, so a resumed or repeated backfill never refetches
+    path = snapshot_path(timestamp)
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            return file.read()
+    # id_ asks for the page exactly as archived, without the Wayback toolbar
+    response = fetch(f"{wayback}/web/{timestamp}id_/{original}", session, limiter)
+    response.raise_for_status()
+    atomic_write(path, response.content)
+    return response.content
+
+
+def parse_snapshot(html):
+    # Same extraction as check_for_updates()
+    block = extract_stats_block(html)
+    if block is not None:
+        try:
+            return parse_dashboard_stream([block])
+        except:
+            pass
+    return parse_dashboard(html)
+
+
+def load_index():
+    try:
+        with open(os.path.join(BACKFILL_CACHE, "index.json"), "r") as file:
+            return json.load(file)
+    except:
+        return {}
+
+
+def save_index(index):
+    atomic_write(os.path.join(BACKFILL_CACHE, "index.json"), json.dumps(index))
+
+
+def backfill(
+    start=None, end=None, workers=4, wayback=WAYBACK, covid_data=None, limiter=None
+):
+    """
+    Fetches and parses every archived snapshot not already in the index, then
+    fills in history for the days our own runs missed (one capture per day,
+    the latest). Days already in the history are left alone.
+    Returns the number of days added.
+    """
+
+    os.makedirs(BACKFILL_CACHE, exist_ok=True)
+    session = create_session(workers)
+    limiter = HostRateLimiter() if limiter is None else limiter
+    index = load_index()
+    snapshots = list_snapshots(session, limiter, start, end, wayback)
+    pending = [snapshot for snapshot in snapshots if snapshot[0] not in index]
+    print(f"{len(snapshots)} snapshots, {len(pending)} not yet processed")
+
+    def process(snapshot):
+        timestamp, original = snapshot
+        try:
+            html = fetch_snapshot(session, limiter, timestamp, original, wayback)
+            data, _ = parse_snapshot(html)
+            return (timestamp, data)
+        except:
+            print(f"Snapshot {timestamp} failed")
+            traceback.print_exc()
+            return (timestamp, None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for done, (timestamp, data) in enumerate(pool.map(process, pending), 1):
+            # Failed fetches stay out of the index so they're retried next time
+            if data is not None:
+                index[timestamp] = data
+            if done % 100 == 0:
+                save_index(index)
+    save_index(index)
+
+    # Latest capture per day wins
+    by_day = {}
+    for timestamp in sorted(index):
+        by_day[datetime.strptime(timestamp[:8], "%Y%m%d").date()] = index[timestamp]
+
+    covid_data = load_previous() if covid_data is None else covid_data
+    history = covid_data.historicalData
+    added = {day: data for day, data in by_day.items() if day not in history}
+    if added:
+        history.update(added)
+        covid_data.replace_history(history)
+        save(covid_data)
+    return len(added)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill history from the Wayback Machine"
+    )
+    parser.add_argument("--from", dest="start", help="earliest capture, YYYYMMDD")
+    parser.add_argument("--to", dest="end", help="latest capture, YYYYMMDD")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    added = backfill(args.start, args.end, args.workers)
+    print(f"Done. Added {added} days of history")
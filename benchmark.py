@@ -0,0 +1,940 @@
+#!/usr/bin/env python3
+# Usage: ./benchmark.py [benchmark names...] [--save-baseline] [--check]
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+# Timings and peak memory recorded with --save-baseline, checked with --check.
+# Timings depend on the machine, so record your own before comparing.
+BASELINE = os.path.join(FIXTURES, "baseline.json")
+# A result regresses when it exceeds its baseline by the tolerance factor and
+# by the slack, so that sub-millisecond results don't flap on noise
+TIME_TOLERANCE = 2.0
+TIME_SLACK = 0.002
+MEMORY_TOLERANCE = 1.25
+MEMORY_SLACK = 64 * 1024
+
+# "benchmark/section/name" -> (seconds, peak bytes) for everything report()ed
+RESULTS = {}
+_benchmark = None
+_section = None
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as file:
+        return file.read()
+
+
+def measure(func, repeat=20):
+    # Fastest of repeat runs (the least disturbed by whatever else the machine
+    # is doing), and peak traced allocation of a single run, after one untimed
+    # run to warm up caches and lazy imports
+    func()
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (elapsed, peak)
+
+
+def section(title):
+    global _section
+    _section = title
+    print(title)
+
+
+def report(name, elapsed, peak):
+    RESULTS["/".join(filter(None, [_benchmark, _section, name]))] = (elapsed, peak)
+    print(f"  {name:<40} {elapsed * 1000:>10.3f} ms {peak / 1024:>10.1f} KiB peak")
+
+
+def quietly(func, *args, **kwargs):
+    # Calls func with its progress messages and tracebacks swallowed
+    import io
+    from contextlib import redirect_stderr, redirect_stdout
+
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def bench_dashboard_parse():
+    from main import extract_stats_block, parse_dashboard, parse_dashboard_stream
+
+    for fixture in ["dashboard_daily.html", "dashboard_weekly.html"]:
+        html = read_fixture(fixture)
+        chunks = [html[i : i + 16384] for i in range(0, len(html), 16384)]
+        section(f"{fixture} ({len(html) / 1024:.1f} KiB)")
+        report("beautifulsoup (full document)", *measure(lambda: parse_dashboard(html)))
+        report(
+            "lxml target (streamed chunks)",
+            *measure(lambda: parse_dashboard_stream(chunks)),
+        )
+        report(
+            "lxml target (stats block only)",
+            *measure(lambda: parse_dashboard_stream([extract_stats_block(html)])),
+        )
+
+
+def synthetic_history(days, end=None):
+    from random import Random
+
+    rng = Random(days)
+    end = date.today() if end is None else end
+    return {
+        end - timedelta(days=i): [positives, 7 * positives, 0, 2000 + i % 500, 0]
+        for i, positives in ((i, rng.randint(0, 20)) for i in range(days))
+        # Leave some holes like a real cache has
+        if rng.random() < 0.9
+    }
+
+
+def bench_rolling_sums():
+    from main import CovidData
+    from timeseries import TimeSeriesStore
+
+    for days in [120, 365 * 4]:
+        store = TimeSeriesStore()
+        store.replace_all(synthetic_history(days))
+        data = CovidData(store)
+        end = date.today()
+        start = end - timedelta(days=days - 1)
+        dates = [start + timedelta(days=i) for i in range(days)]
+        section(f"{days} days of history")
+        report(
+            "sum(get_rolling_iterator()) per day",
+            *measure(lambda: [sum(data.get_rolling_iterator(d)) for d in dates], 3),
+        )
+        report(
+            "get_rolling_sums() in one call",
+            *measure(lambda: data.get_rolling_sums(start, end), 3),
+        )
+
+
+def bench_analytics():
+    from analytics import Analytics
+    from main import CovidData
+    from timeseries import TimeSeriesStore
+
+    for years in [1, 10, 50]:
+        days = 365 * years
+        store = TimeSeriesStore()
+        store.replace_all(synthetic_history(days))
+        data = CovidData(store)
+        end = date.today()
+        dates = [end - timedelta(days=i) for i in range(days - 1, -1, -1)]
+        history = dict(store.items())
+
+        def per_day():
+            # The same metrics, one day at a time in plain Python
+            for day in dates:
+                weekly = data.get_rolling_sum(day, 6)
+                data.get_rolling_sum(day, 13)
+                last_week = data.get_rolling_sum(day - timedelta(days=7), 6)
+                weekly / last_week if last_week else None
+                case_data = history.get(day)
+                if case_data and case_data[3]:
+                    case_data[1] / case_data[3]
+
+        analytics = Analytics.from_store(store)
+
+        def append():
+            analytics.append(end, [5, 35, 0, 2000, 0])
+            analytics.alerts(end)
+
+        section(f"{years} year(s) of history")
+        report("python, per day", *measure(per_day, 3))
+        report(
+            "numpy, one pass (from_store)",
+            *measure(lambda: Analytics.from_store(store)),
+        )
+        report("numpy, append() + alerts()", *measure(append, 200))
+
+
+def rss():
+    # Current resident set size in bytes (Linux)
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def bench_graph_render(renders=100):
+    from main import CovidData
+    from renderer import GraphRenderer, graph_inputs
+    from timeseries import TimeSeriesStore
+
+    store = TimeSeriesStore()
+    store.replace_all(synthetic_history(renders + 30))
+    data = CovidData(store)
+    today = date.today()
+    # A different window per render so nothing hits the cache
+    inputs = [graph_inputs(data, today - timedelta(days=i)) for i in range(renders + 1)]
+
+    for label, cached in [("uncached", False), ("cached", True)]:
+        renderer = GraphRenderer()
+        # Warm up so font/backend loading isn't counted as growth
+        renderer.render(inputs[0])
+        before = rss()
+        start = time.perf_counter()
+        for i in range(renders):
+            renderer.render(inputs[0] if cached else inputs[i + 1])
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {renders} {label} renders: {elapsed / renders * 1000:.2f} ms/render, "
+            f"RSS {before / 2**20:.1f} -> {rss() / 2**20:.1f} MiB"
+        )
+
+
+def bench_site(years=(10, 30)):
+    import tempfile
+
+    import sitegen
+    from main import CovidData
+    from timeseries import TimeSeriesStore
+
+    def timed(label, build):
+        start = time.perf_counter()
+        built, _ = build()
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<40} {elapsed * 1000:>10.1f} ms, {len(built)} artifacts built")
+
+    cwd = os.getcwd()
+    for count in years:
+        store = TimeSeriesStore()
+        store.replace_all(
+            synthetic_history(365 * count, date.today() - timedelta(days=1))
+        )
+        data = CovidData(store)
+        print(f"{count} years of history")
+        with tempfile.TemporaryDirectory() as out:
+            # The graph's disk cache lives under the working directory
+            os.chdir(out)
+            try:
+                build = lambda full=False: sitegen.build_site(data, "site", full)
+                timed("full build", lambda: build(True))
+                timed("incremental, nothing new", build)
+                data.update([3, 21, 0, 2000, 0])
+                timed("incremental, one new day", build)
+            finally:
+                os.chdir(cwd)
+
+
+def serve_fixtures(latency=0.0, directory=FIXTURES):
+    # Local stand-in for RPI's site; returns (server, base url). Extensionless
+    # paths like /announcements/foo are served from foo.html
+    import threading
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            super().do_GET()
+
+        def translate_path(self, path):
+            translated = super().translate_path(path)
+            if not os.path.exists(translated) and os.path.exists(f"{translated}.html"):
+                return f"{translated}.html"
+            return translated
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(Handler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, f"http://127.0.0.1:{server.server_address[1]}")
+
+
+def serve_discord(limit=None, window=1.0):
+    # Local stand-in for Discord webhooks; returns (server, webhook url) and
+    # answers every post like ?wait=true does, with the created message. Any
+    # /api/webhooks/<id>/<token> path works. Message edits (PATCH
+    # .../messages/<id>) are kept in server.edits as (message id, payload).
+    # With limit, each webhook takes limit posts per window seconds, sends
+    # Discord's X-RateLimit-* headers and answers 429 beyond that. server.posts
+    # keeps (webhook path, payload) for every accepted post (payload is None
+    # for multipart posts, the ones with files), server.limited
+    # counts 429s, and server.fail_after maps a webhook path to the number of
+    # posts it accepts before answering 400
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    lock = threading.Lock()
+    # webhook path -> (clock time its window ends, posts in the window)
+    windows = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            webhook = self.path.split("?")[0]
+            headers = {}
+            with lock:
+                accepted = len([post for post in server.posts if post[0] == webhook])
+                if accepted >= server.fail_after.get(webhook, accepted + 1):
+                    return self.respond({"message": "Invalid Form Body"}, 400)
+                if limit is not None:
+                    now = time.monotonic()
+                    end, used = windows.get(webhook, (0, 0))
+                    if now >= end:
+                        end, used = now + window, 0
+                    if used >= limit:
+                        server.limited += 1
+                        return self.respond({"retry_after": end - now}, 429)
+                    windows[webhook] = (end, used + 1)
+                    headers = {
+                        "X-RateLimit-Limit": limit,
+                        "X-RateLimit-Remaining": limit - used - 1,
+                        "X-RateLimit-Reset-After": f"{end - now:.3f}",
+                    }
+                is_json = self.headers.get("Content-Type") == "application/json"
+                server.posts.append((webhook, json.loads(body) if is_json else None))
+            self.respond({"id": "1", "channel_id": "1"}, headers=headers)
+
+        def do_PATCH(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            message_id = self.path.rsplit("/", 1)[1]
+            self.server.edits.append((message_id, payload))
+            self.respond(dict(payload, id=message_id, channel_id="1"))
+
+        def respond(self, message, status=200, headers={}):
+            body = json.dumps(message).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, str(value))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.edits, server.posts, server.limited, server.fail_after = [], [], 0, {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, f"http://127.0.0.1:{server.server_address[1]}/api/webhooks/1/token")
+
+
+def serve_wayback(captures):
+    # Local stand-in for the Wayback Machine; returns (server, base url, log).
+    # captures is {timestamp: html, or None for a 404}, looked up per request.
+    # The CDX API pages through it with resume keys like the real one, and
+    # log records the path of every request
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
+
+    log = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            log.append(url.path)
+            if url.path == "/cdx/search/cdx":
+                query = parse_qs(url.query)
+                timestamps = sorted(captures)
+                first = int(query.get("resumeKey", ["0"])[0])
+                last = first + int(query["limit"][0])
+                rows = [["timestamp", "original"]] + [
+                    [timestamp, "covid19.rpi.edu/dashboard"]
+                    for timestamp in timestamps[first:last]
+                ]
+                if last < len(timestamps):
+                    rows += [[], [str(last)]]
+                return self.respond(200, json.dumps(rows).encode("utf-8"))
+            # /web/<timestamp>id_/<original>
+            html = captures.get(url.path.split("/")[2][: -len("id_")])
+            if html is None:
+                return self.respond(404, b"Not found")
+            self.respond(200, html)
+
+        def respond(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, f"http://127.0.0.1:{server.server_address[1]}", log)
+
+
+def bench_daemon():
+    import daemon
+
+    # Correctness is covered by tests/test_daemon.py
+    noon = datetime(2021, 1, 5, 12, 0)
+    scheduler = daemon.PollScheduler()
+    update_times = [f"2021-01-{day:02}T17:{day:02}" for day in range(1, 31)] * 2
+    section("PollScheduler")
+    report(
+        f"next_interval(), {len(update_times)} update times",
+        *measure(lambda: scheduler.next_interval(noon, update_times)),
+    )
+
+
+def bench_multisite(sites=8, latency=0.2):
+    import io
+    import socket
+    import tempfile
+    from contextlib import redirect_stderr, redirect_stdout
+
+    import main
+    import multisite
+    from webhooks import HostRateLimiter, create_session
+
+    other = main.SiteProfile(
+        "example",
+        "Example University COVID Dashboard",
+        None,
+        "covid-metrics",
+        "metric-value",
+        None,
+        {3: (0, 1, None, 2, None)},
+    )
+    server, base = serve_fixtures(latency)
+    # Two host names for the one server, so politeness limits apply per name
+    hosts = [base, base.replace("127.0.0.1", "localhost")]
+    profiles = []
+    for i in range(sites):
+        fixture = ["dashboard_daily", "dashboard_weekly", "dashboard_other"][i % 3]
+        profile = other if fixture == "dashboard_other" else main.RPI
+        url = f"{hosts[i % 2]}/{fixture}.html"
+        profiles.append(profile._replace(name=f"site{i}", url=url))
+
+    # Sites that fail in different ways, which must not hold up the rest
+    hung = socket.socket()
+    hung.bind(("127.0.0.1", 0))
+    hung.listen()
+    profiles += [
+        main.RPI._replace(name="missing", url=f"{base}/no_such_dashboard"),
+        main.RPI._replace(name="wrong_markup", url=f"{base}/dashboard_other.html"),
+        main.RPI._replace(name="refused", url="http://127.0.0.1:9/dashboard"),
+        main.RPI._replace(
+            name="hung", url=f"http://127.0.0.1:{hung.getsockname()[1]}/"
+        ),
+    ]
+    # Put back afterwards, for the benchmarks that run after this one
+    saved = main.FETCH_TIMEOUT, main.WEBHOOKS
+    main.FETCH_TIMEOUT = 2
+    main.WEBHOOKS = None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp:
+        # Poll states and graph caches are written to the working directory
+        os.chdir(temp)
+        try:
+            session = create_session(pool_size=multisite.MAX_WORKERS)
+            for label, workers in [("one at a time", 1), ("concurrent", 8)]:
+                tracked = [
+                    multisite.Site(profile, main.CovidData(), {})
+                    for profile in profiles
+                ]
+                limiter = HostRateLimiter(0.05)
+                # poll() and failing sites are chatty
+                with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+                    # First round records every site; the timed one finds nothing new
+                    multisite.poll_sites(tracked, session, limiter, True, None, workers)
+                    start = time.perf_counter()
+                    results = multisite.poll_sites(
+                        tracked, session, limiter, True, None, workers
+                    )
+                    elapsed = time.perf_counter() - start
+                failed = [
+                    name for name, r in results.items() if isinstance(r, Exception)
+                ]
+                print(
+                    f"  {label:<40} {elapsed * 1000:>10.1f} ms for {len(tracked)} sites, "
+                    f"failed: {', '.join(failed)}"
+                )
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            hung.close()
+            main.FETCH_TIMEOUT, main.WEBHOOKS = saved
+
+
+def bench_backfill(days=600, page_size=250):
+    import re
+    import tempfile
+
+    import backfill
+    import main
+    from webhooks import HostRateLimiter
+
+    # Two captures a day, the later one wins; tests/test_backfill.py checks
+    # what ends up in the history
+    template = read_fixture("dashboard_daily.html").decode()
+    first_stat = re.compile(r"(field--name-field-stat field--type-string[^>]*>)3<")
+    first_day = date(2020, 8, 1)
+    captures = {}
+    for i in range(days):
+        day = first_day + timedelta(days=i)
+        for hour, positives in [(9, 100 + i % 50), (17, i % 50)]:
+            html = first_stat.sub(rf"\g<1>{positives}<", template, count=1)
+            captures[f"{day:%Y%m%d}{hour:02}0000"] = html.encode("utf-8")
+
+    server, base, log = serve_wayback(captures)
+    page_size, backfill.CDX_PAGE_SIZE = backfill.CDX_PAGE_SIZE, page_size
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp:
+        # The snapshot cache and index.json live under the working directory
+        os.chdir(temp)
+        try:
+            data = main.CovidData()
+            run = lambda: quietly(
+                backfill.backfill,
+                wayback=base,
+                covid_data=data,
+                limiter=HostRateLimiter(0),
+            )
+
+            section(f"{len(captures)} captures over {days} days")
+            start = time.perf_counter()
+            added = run()
+            elapsed = time.perf_counter() - start
+            print(f"  {'first run':<40} {elapsed * 1000:>10.1f} ms, {added} days added")
+            report("resumed, nothing new", *measure(run, 3))
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            backfill.CDX_PAGE_SIZE = page_size
+
+
+def bench_archive(jobs=50):
+    import tempfile
+
+    import archiver
+
+    # Correctness is covered by tests/test_archiver.py
+    capture = lambda url: f"https://web.archive.org/web/20210101000000/{url}"
+    with tempfile.TemporaryDirectory() as temp:
+
+        def drain():
+            path = os.path.join(temp, "archive")
+            if os.path.exists(path):
+                os.remove(path)
+            queue = archiver.ArchiveQueue(path)
+            for i in range(jobs):
+                queue.enqueue(f"https://{i}/dashboard", str(i))
+            quietly(queue.run_pending, capture)
+
+        section(f"{jobs} jobs")
+        report("enqueue() and run_pending()", *measure(drain, 3))
+
+
+def bench_startup(runs=5):
+    import subprocess
+    import tempfile
+
+    server, base = serve_fixtures()
+    repo = os.path.dirname(os.path.abspath(__file__))
+    # Ends by reporting the process' own peak RSS in KiB on stderr. ru_maxrss
+    # would carry over our peak through fork/exec, VmHWM starts afresh at exec
+    script = (
+        f"import sys; sys.path.insert(0, {repo!r}); sys.argv.append('--ci')\n"
+        f"import main; main.DASHBOARD = '{base}/dashboard_daily.html'\n"
+        "main.WEBHOOKS = None; main.main()\n"
+        "with open('/proc/self/status') as status:\n"
+        "    peak = [line.split()[1] for line in status if line.startswith('VmHWM:')]\n"
+        "print(peak[0], file=sys.stderr)"
+    )
+    with tempfile.TemporaryDirectory() as cwd:
+
+        def run(*flags):
+            start = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, *flags, "-c", script],
+                cwd=cwd,
+                capture_output=True,
+                text=True,
+            )
+            elapsed = time.perf_counter() - start
+            if process.returncode != 0:
+                raise RuntimeError(process.stderr)
+            lines = process.stderr.splitlines()
+            return elapsed, int(lines[-1]) * 1024, lines[:-1]
+
+        # Prime the caches so the timed runs take the no-change path
+        run()
+        # Fastest run, like measure()
+        elapsed, peak, _ = min(run() for _ in range(runs))
+        _, import_peak, imports = run("-X", "importtime")
+    server.shutdown()
+
+    # -X importtime lines: "import time: self | cumulative | name"
+    top_level = []
+    for line in imports:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Top level modules and what they import directly
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if cumulative.strip().isdigit() and depth <= 1:
+            top_level.append((int(cumulative), depth, name.strip()))
+    # Peaks here are the whole process' RSS, not traced allocations
+    section(f"main.py, fastest of {runs}")
+    report("no-change run (wall)", elapsed, peak)
+    total = sum(c for c, depth, _ in top_level if depth == 0)
+    report("imports (-X importtime)", total / 1e6, import_peak)
+    print("  heaviest imports:")
+    for cumulative, _, name in sorted(top_level, reverse=True)[:8]:
+        print(f"    {name:<30} {cumulative / 1000:>8.1f} ms")
+
+
+def bench_crawl(latency=0.1):
+    import rpi_scraper
+    import webhooks
+
+    server, base = serve_fixtures(latency, os.path.join(FIXTURES, "site"))
+    home_url, rpi_scraper.HOME_URL = rpi_scraper.HOME_URL, base
+    try:
+        paths = rpi_scraper.collect_communications_paths()
+        print(f"{len(paths)} announcements, {latency * 1000:.0f} ms injected latency")
+        for label, workers, interval in [
+            ("sequential, no session", None, None),
+            ("1 worker, pooled session", 1, 0),
+            ("8 workers, pooled session", 8, 0),
+            (f"8 workers, {webhooks.HOST_INTERVAL}s per-host limit", 8, None),
+        ]:
+            start = time.perf_counter()
+            if workers is None:
+                results = [
+                    rpi_scraper.collect_beautifulsoup_tags(path) for path in paths
+                ]
+            else:
+                limiter = webhooks.HostRateLimiter(
+                    webhooks.HOST_INTERVAL if interval is None else interval
+                )
+                results = rpi_scraper.crawl_announcements(
+                    paths, workers, limiter=limiter
+                )
+            elapsed = time.perf_counter() - start
+            print(f"  {label:<40} {elapsed * 1000:>10.1f} ms")
+    finally:
+        server.shutdown()
+        rpi_scraper.HOME_URL = home_url
+
+
+def bench_seen_store(stored=100000, listing=50):
+    import tempfile
+    from announcement_cache import AnnouncementCache
+
+    paths = [f"/announcements/announcement-{i}" for i in range(stored)]
+    # A listing page: mostly old links plus a few new ones
+    listed = paths[-(listing - 5) :] + [f"/announcements/new-{i}" for i in range(5)]
+    section(f"{stored} stored paths, {listing} listed")
+    with tempfile.TemporaryDirectory() as directory:
+        lines = os.path.join(directory, "lines")
+        with open(lines, "w") as f:
+            f.writelines(path + "\n" for path in paths)
+
+        def old_filter():
+            with open(lines, "r") as f:
+                cache_paths = [path.rstrip("\n") for path in f.readlines()]
+            return [path for path in listed if path not in cache_paths]
+
+        start = time.perf_counter()
+        cache = AnnouncementCache(os.path.join(directory, "db"), lines)
+        elapsed = time.perf_counter() - start
+        print(f"  {'import line file into sqlite':<40} {elapsed * 1000:>10.3f} ms")
+        report("line file + list scan (old)", *measure(old_filter, 3))
+        report("sqlite filter_new()", *measure(lambda: cache.filter_new(listed)))
+        report(
+            "sqlite mark_seen() batch of 5",
+            *measure(lambda: cache.mark_seen(listed[-5:])),
+        )
+        cache.close()
+
+
+def bench_announcement_extract():
+    from bs4 import BeautifulSoup
+    import rpi_scraper
+
+    directory = os.path.join(FIXTURES, "site", "announcements")
+    for name in sorted(os.listdir(directory)):
+        slug = name[: -len(".html")]
+        html = read_fixture(os.path.join("site", "announcements", name)).decode()
+
+        def old():
+            soup = BeautifulSoup(html, features="lxml")
+            bs_tags = rpi_scraper.find_beautifulsoup_tags(soup)
+            return rpi_scraper.get_post_author_date_and_content(bs_tags)
+
+        # Both are checked against the goldens by tests/test_announcements.py
+        section(f"{slug} ({len(html) / 1024:.1f} KiB)")
+        report("soup.find x3 + html2text", *measure(old))
+        report(
+            "lxml single pass", *measure(lambda: rpi_scraper.extract_announcement(html))
+        )
+
+
+def bench_announcement_posting(count=30, limit=5, window=0.1):
+    import rpi_scraper
+    import webhooks
+
+    # Correctness (pacing, ordering, what counts as posted) is covered by
+    # tests/test_announcements.py
+    directory = os.path.join(FIXTURES, "site", "announcements")
+    extracted = [
+        rpi_scraper.extract_announcement(
+            read_fixture(os.path.join("site", "announcements", name)).decode()
+        )
+        for name in sorted(os.listdir(directory))
+    ]
+    # Long enough to be split over two or three embeds each
+    announcements = []
+    for i in range(count):
+        data = dict(extracted[i % len(extracted)])
+        data["content"] = "\n\n".join(
+            [data["content"]] * (7000 // len(data["content"]) + 1)
+        )
+        announcements.append((f"/announcements/long-{i}", data, i % 4 == 0))
+    embeds = sum(
+        len(rpi_scraper.announcement_embeds(data, path, edited))
+        for path, data, edited in announcements
+    )
+
+    discord, webhook = serve_discord(limit, window)
+    urls = [webhook, webhook.replace("/1/", "/2/")]
+    session = webhooks.create_session()
+    post = lambda: quietly(rpi_scraper.post_announcements, announcements, urls, session)
+    try:
+        section(f"{count} announcements, {embeds} embeds, {limit} posts per {window}s")
+        report("post_announcements()", *measure(post, 1))
+        print(f"  {discord.limited} responses were 429s")
+    finally:
+        session.close()
+        discord.shutdown()
+
+
+def bench_pipeline(history=(14, 365, 3650, 365 * 50)):
+    # Every stage of a run, replayed offline against the recorded fixtures
+    import io
+    import tempfile
+    from contextlib import redirect_stdout
+    from io import BytesIO
+
+    import main
+    import renderer
+    import rpi_scraper
+    from timeseries import TimeSeriesStore
+    from webhooks import create_session
+
+    dashboards, base = serve_fixtures()
+    site, site_base = serve_fixtures(directory=os.path.join(FIXTURES, "site"))
+    discord, webhook = serve_discord()
+    # Put back afterwards, later benchmarks compare against the real URLs
+    saved = (main.DASHBOARD, main.WEBHOOKS, rpi_scraper.HOME_URL, renderer._renderer)
+    main.DASHBOARD = f"{base}/dashboard_daily.html"
+    main.WEBHOOKS = [webhook]
+    rpi_scraper.HOME_URL = site_base
+    session = create_session()
+    # Drawn without a disk cache, and its memory cache is cleared per render
+    renderer._renderer = renderer.GraphRenderer()
+
+    try:
+        section("dashboard_daily.html")
+        report(
+            "check_for_updates(), full fetch",
+            *measure(lambda: main.check_for_updates(session=session)),
+        )
+        poll_state = {}
+        main.check_for_updates(poll_state, session)
+        report(
+            "check_for_updates(), not modified",
+            *measure(lambda: main.check_for_updates(poll_state, session)),
+        )
+
+        directory = os.path.join(FIXTURES, "site", "announcements")
+        paths = [
+            f"/announcements/{name[: -len('.html')]}"
+            for name in sorted(os.listdir(directory))
+        ]
+        section(f"{len(paths)} announcements")
+        collect = lambda: [
+            rpi_scraper.collect_beautifulsoup_tags(path, session) for path in paths
+        ]
+        report("collect_beautifulsoup_tags()", *measure(collect, 5))
+        announcements = [
+            (rpi_scraper.get_post_author_date_and_content(tags), path)
+            for tags, path in zip(collect(), paths)
+        ]
+        report(
+            "parse_discord_message()",
+            *measure(
+                lambda: [
+                    rpi_scraper.parse_discord_message(data, path)
+                    for data, path in announcements
+                ]
+            ),
+        )
+
+        # Also warms up matplotlib, so font loading isn't counted below
+        recent = main.CovidData()
+        recent.replace_history(synthetic_history(14))
+        png = main.create_graph(recent).getvalue()
+        with tempfile.TemporaryDirectory() as temp:
+            for days in history:
+                path = os.path.join(temp, f"series_{days}")
+                store = TimeSeriesStore(path)
+                store.replace_all(synthetic_history(days))
+                store.close()
+                section(f"{days} days of history")
+                report(
+                    "load_previous()",
+                    *measure(lambda: main.load_previous(path).store.close()),
+                )
+                data = main.load_previous(path)
+                report(
+                    "update() + save()",
+                    *measure(
+                        lambda: (data.update([5, 35, 0, 2000, 0]), main.save(data))
+                    ),
+                )
+
+                def graph():
+                    renderer._renderer._cache.clear()
+                    return main.create_graph(main.CovidData(data.store))
+
+                report("create_graph(), not cached", *measure(graph, 3))
+                data.store.close()
+
+        section("mocked discord webhook")
+        post = lambda: main.post_discord(
+            14,
+            10,
+            [5, 35, 120, 2000, 90000],
+            [3, 30, 115, 1900, 88000],
+            "Updated today",
+            main.DASHBOARD,
+            BytesIO(png),
+        )
+        with redirect_stdout(io.StringIO()):
+            failed = [result for result in post() if result.error is not None]
+            if failed:
+                raise RuntimeError(f"Posting to the stand-in failed: {failed}")
+            timings = measure(post, 5)
+        report("post_discord() with graph", *timings)
+    finally:
+        session.close()
+        for server in [dashboards, site, discord]:
+            server.shutdown()
+        main.DASHBOARD, main.WEBHOOKS, rpi_scraper.HOME_URL, renderer._renderer = saved
+
+
+def bench_change_detection():
+    import changes
+
+    # The table in fixtures/change_cases.json is checked by tests/test_changes.py
+    snapshots = [[changes.snapshot_hash(s), s] for s in synthetic_history(10).values()]
+    report(
+        "classify() against a full window",
+        *measure(
+            lambda: changes.classify(
+                [5, 35, 0, 2000, 0], [3, 21, 0, 2000, 0], snapshots
+            ),
+            1000,
+        ),
+    )
+
+
+def load_baseline(path=BASELINE):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results, path=BASELINE):
+    # Merged into the existing baseline, so recording one benchmark keeps the rest
+    baseline = load_baseline(path)
+    baseline.update(
+        {key: {"seconds": s, "peak_bytes": peak} for key, (s, peak) in results.items()}
+    )
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(baseline, file, indent=1, sort_keys=True)
+        file.write("\n")
+    os.replace(f"{path}.tmp", path)
+
+
+def regressions(results, baseline):
+    # One line per result that got slower or uses more memory than its baseline
+    found = []
+    for key, (elapsed, peak) in sorted(results.items()):
+        if key not in baseline:
+            continue
+        seconds, peak_bytes = baseline[key]["seconds"], baseline[key]["peak_bytes"]
+        if elapsed > seconds * TIME_TOLERANCE and elapsed - seconds > TIME_SLACK:
+            found.append(f"{key}: {seconds * 1000:.3f} -> {elapsed * 1000:.3f} ms")
+        if peak > peak_bytes * MEMORY_TOLERANCE and peak - peak_bytes > MEMORY_SLACK:
+            found.append(
+                f"{key}: {peak_bytes / 1024:.1f} -> {peak / 1024:.1f} KiB peak"
+            )
+    return found
+
+
+BENCHMARKS = {
+    "dashboard_parse": bench_dashboard_parse,
+    "rolling_sums": bench_rolling_sums,
+    "analytics": bench_analytics,
+    "graph_render": bench_graph_render,
+    "site": bench_site,
+    "startup": bench_startup,
+    "daemon": bench_daemon,
+    "multisite": bench_multisite,
+    "crawl": bench_crawl,
+    "backfill": bench_backfill,
+    "archive": bench_archive,
+    "seen_store": bench_seen_store,
+    "announcement_extract": bench_announcement_extract,
+    "announcement_posting": bench_announcement_posting,
+    "pipeline": bench_pipeline,
+    "change_detection": bench_change_detection,
+}
+
+if __name__ == "__main__":
+    selected = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    for name in selected or list(BENCHMARKS):
+        _benchmark, _section = name, None
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+
+    if "--save-baseline" in sys.argv:
+        save_baseline(RESULTS)
+        print(f"Recorded {len(RESULTS)} results in {BASELINE}")
+    if "--check" in sys.argv:
+        baseline = load_baseline()
+        if not baseline:
+            sys.exit(f"No baseline at {BASELINE}, record one with --save-baseline")
+        found = regressions(RESULTS, baseline)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(f"{len(found)} regression(s) against {BASELINE}")
+        checked = len(RESULTS.keys() & baseline.keys())
+        print(f"No regressions in {checked} results checked against the baseline")
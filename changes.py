@@ -0,0 +1,98 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+from collections import namedtuple
+
+from timeseries import FIELD_NAMES
+
+NEW = "new"
+RESET = "reset"
+REVERT = "revert"
+NOOP = "noop"
+KINDS = (NEW, RESET, REVERT, NOOP)
+
+# window: how many recent snapshots to remember
+# reset_fields: case_data fields the dashboard zeroes or rolls over by itself;
+#   an update that only lowers these is a reset, not news
+# post: which kinds of change get posted
+Rules = namedtuple("Rules", ["window", "reset_fields", "post"])
+RULES = Rules(window=10, reset_fields=(0, 1, 3), post=(NEW,))
+
+
+def make_rules(overrides):
+    # RULES with the fields in overrides (config.CHANGE_RULES) replaced
+    unknown = sorted(set(overrides) - set(Rules._fields))
+    if unknown:
+        raise ValueError(
+            f"Unknown CHANGE_RULES fields {unknown}, expected {list(Rules._fields)}"
+        )
+    rules = RULES._replace(**overrides)
+    kinds = sorted(set(rules.post) - set(KINDS))
+    if kinds:
+        raise ValueError(
+            f"Unknown change kinds {kinds} in CHANGE_RULES post, expected {list(KINDS)}"
+        )
+    return rules
+
+
+# kind is one of NEW/RESET/REVERT/NOOP; diff maps each changed field's name to
+# (last recorded value, current value)
+Change = namedtuple("Change", ["kind", "diff", "hash"])
+
+
+def snapshot_hash(case_data):
+    return hashlib.sha256(repr(list(case_data)).encode("utf-8")).hexdigest()
+
+
+def field_diff(previous, current):
+    return {
+        FIELD_NAMES[i]: (old, new)
+        for i, (old, new) in enumerate(zip(previous, current))
+        if old != new
+    }
+
+
+def classify(current, previous, snapshots=(), rules=RULES):
+    """
+    Decides what a freshly parsed dashboard means. previous is the last
+    recorded case_data, snapshots the [hash, case_data] window remember()
+    keeps (oldest first). Anything identical to the latest snapshot, or to
+    previous, is a no-op; a return to an older snapshot is a revert (the
+    dashboard flip-flopping); an update that only lowers reset_fields is a
+    reset; the rest is new data.
+    """
+
+    digest = snapshot_hash(current)
+    diff = field_diff(previous, current)
+    latest = snapshots[-1][0] if snapshots else None
+    if digest == latest or not diff:
+        return Change(NOOP, diff, digest)
+    if any(digest == seen for seen, _ in snapshots[:-1]):
+        return Change(REVERT, diff, digest)
+    reset = [FIELD_NAMES[i] for i in rules.reset_fields]
+    if all(name in reset and new < old for name, (old, new) in diff.items()):
+        return Change(RESET, diff, digest)
+    return Change(NEW, diff, digest)
+
+
+def remember(poll_state, case_data, rules=RULES):
+    # Makes case_data the latest snapshot in poll_state's window
+    digest = snapshot_hash(case_data)
+    snapshots = [s for s in poll_state.get("snapshots", []) if s[0] != digest]
+    snapshots.append([digest, list(case_data)])
+    poll_state["snapshots"] = snapshots[-rules.window :]
+
+
+def describe(change):
+    fields = ", ".join(
+        f"{name} {old} -> {new}" for name, (old, new) in change.diff.items()
+    )
+    return f"{change.kind}" + (f" ({fields})" if fields else "")
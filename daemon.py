@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Usage: ./daemon.py [--ci]
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import signal
+import sys
+import threading
+import traceback
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+import metrics
+from archiver import get_queue
+from main import load_poll_state, load_previous, poll, save_poll_state, start_archiving
+from webhooks import create_session
+
+MINUTES_PER_DAY = 24 * 60
+
+
+class PollScheduler:
+    """
+    Picks the delay before the next poll. Polls every min_interval seconds
+    within window minutes of a time of day RPI has published at before, and
+    backs off exponentially (up to max_interval) outside of those windows or
+    once an update has been seen, without sleeping past the next window.
+    """
+
+    def __init__(
+        self, min_interval=60, max_interval=30 * 60, default_interval=5 * 60, window=45
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.window = window
+        self.interval = min_interval
+
+    def publish_minutes(self, update_times):
+        minutes = set()
+        for when in update_times:
+            when = datetime.fromisoformat(when)
+            minutes.add(when.hour * 60 + when.minute)
+        return sorted(minutes)
+
+    def minutes_until_window(self, now, minutes):
+        # 0 if we're inside a publish window, otherwise minutes until the next one
+        current = now.hour * 60 + now.minute
+        best = MINUTES_PER_DAY
+        for minute in minutes:
+            distance = (minute - current) % MINUTES_PER_DAY
+            if distance <= self.window or MINUTES_PER_DAY - distance <= self.window:
+                return 0
+            best = min(best, distance - self.window)
+        return best
+
+    def next_interval(self, now, update_times, changed=False):
+        minutes = self.publish_minutes(update_times)
+        if not minutes:
+            # Nothing learned yet
+            return self.default_interval
+
+        latest = max(datetime.fromisoformat(when) for when in update_times)
+        if changed or now - latest < timedelta(minutes=2 * self.window):
+            # RPI just published, it won't again for a while
+            self.interval = self.max_interval
+            return self.interval
+
+        until = self.minutes_until_window(now, minutes)
+        if until == 0:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+        if until > 0:
+            return max(self.min_interval, min(self.interval, until * 60))
+        return self.interval
+
+
+def run_daemon(ci=False, now=None, wait=None, scheduler=None, max_polls=None):
+    """
+    Polls the dashboard until SIGTERM/SIGINT, keeping CovidData and the HTTP
+    session around between polls. now() and wait(seconds) can be swapped out
+    (e.g. for a fake clock); wait should return early once stop is set.
+    """
+
+    now = datetime.now if now is None else now
+    scheduler = PollScheduler() if scheduler is None else scheduler
+    stop = threading.Event()
+    wait = stop.wait if wait is None else wait
+
+    def shutdown(signum, frame):
+        print(f"Got signal {signum}, shutting down after this poll")
+        stop.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+    covid_data = load_previous()
+    poll_state = load_poll_state()
+    # Polls the dashboard and posts to every webhook at once
+    session = create_session()
+    polls = 0
+    try:
+        while not stop.is_set() and (max_polls is None or polls < max_polls):
+            changed = False
+            # A poll that fails part way leaves poll_state alone (its new
+            # fingerprint would hide the update from every later poll)
+            attempt = deepcopy(poll_state)
+            try:
+                changed = poll(
+                    covid_data,
+                    attempt,
+                    ci,
+                    session=session,
+                    now=now(),
+                    render_in_worker=True,
+                )
+                poll_state = attempt
+            except:
+                print("Poll failed")
+                traceback.print_exc()
+            polls += 1
+            # Only touch the disk when something actually changed
+            if changed:
+                save_poll_state(poll_state)
+                # Totals since the daemon started
+                metrics.RUN.write()
+            if not ci:
+                # Retries captures that failed or were cut short earlier
+                if get_queue().pending():
+                    start_archiving(get_queue())
+
+            interval = scheduler.next_interval(
+                now(), poll_state.get("update_times", []), changed
+            )
+            print(f"Next poll at {now() + timedelta(seconds=interval)}")
+            wait(interval)
+    finally:
+        save_poll_state(poll_state)
+        metrics.RUN.write()
+        covid_data.store.close()
+        session.close()
+    return polls
+
+
+if __name__ == "__main__":
+    run_daemon(ci=any(x.lower() == "--ci" for x in sys.argv))
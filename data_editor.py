@@ -8,17 +8,16 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from main import CovidData, load_previous, save
-from datetime import date
+from main import load_previous, save
+from datetime import date, timedelta
 
 
 def print_stats(data):
     print("Current COVID data statistics: ")
     print("RPI ARRAY: ", data.get_case_data())
     print("2 week rolling: ", data.get_rolling())
-    print("Rolling array: ", data.rolling_array)
-    print("Last updated: ", data.last_updated)
-    print("Array index: ", data.array_index)
+    print("Rolling array: ", data.get_rolling_iterator(date.today()))
+    print("Last updated: ", data.get_last_update())
     print("historical: ", data.historicalData)
 
 
@@ -28,25 +27,23 @@ if __name__ == "__main__":
     print_stats(data)
 
     new_rolling = [int(x) for x in input("Please enter a new data array: ").split(",")]
-    new_array_index = len(new_rolling) - 1
     new_day = date.today()
     print("New rolling array ", new_rolling)
-    print("Array index: ", new_array_index)
     print("New last updated: ", new_day)
-    assert new_array_index >= 0
+    assert len(new_rolling) > 0
 
-    # pad off 0s till we get to 14
-    while len(new_rolling) != 14:
-        new_rolling.append(0)
-
-    data.rolling_array = new_rolling
-    data.array_index = new_array_index
-    data.last_updated = new_day
+    # The last entry is today's count, earlier entries are the days before it
+    history = data.historicalData
+    for offset, positives in enumerate(reversed(new_rolling)):
+        day = new_day - timedelta(days=offset)
+        history[day] = [positives] + history.get(day, [0] * 5)[1:]
 
     print("**** STATS HAVE BEEN CHANGED. Please review the changes *****")
-    print_stats(data)
+    print(history)
 
     input("Press any key to continue")
+    data.replace_history(history)
+    print_stats(data)
     save(data)
 
     print("Changes have been saved")
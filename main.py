@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# Usage: ./main.py
+# Usage: ./main.py [--ci] [--force] [--profile]
 """
 Copyright (C) 2020-2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
 
@@ -9,22 +9,28 @@ The above copyright notice and this permission notice shall be included in all c
 
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
+
 import os
-import pickle
+import json
+import hashlib
 import requests
 from random import choice
-from subprocess import run
 import sys
 import traceback
 from datetime import date, timedelta, datetime
+from collections import namedtuple
 from copy import deepcopy
 from itertools import chain
+from functools import lru_cache
 from io import BytesIO
 
-from bs4 import BeautifulSoup
-from discord_webhook import DiscordEmbed, DiscordWebhook
-import matplotlib.pyplot as plot
-import savepagenow
+# Most runs find nothing new and exit, so bs4, discord_webhook, savepagenow and
+# matplotlib (via renderer) are imported where they're used; webhooks is light
+import changes
+import metrics
+from state import atomic_write
+from timeseries import TimeSeriesStore, migrate_pickle
+from webhooks import USER_AGENT
 
 # Import configuration (if available)
 try:
@@ -33,86 +39,384 @@ try:
     WEBHOOKS = config.webhooks
     PSA = config.PSA
     QUIET = config.QUIET
+    # Overrides for fields of changes.RULES, e.g. {"post": ["new", "reset"]}
+    CHANGE_OVERRIDES = getattr(config, "CHANGE_RULES", {})
 except:
     print("No discord webhooks supplied - data will just be stored locally")
     traceback.print_exc()
     WEBHOOKS = None
     PSA = None
     QUIET = False
+    CHANGE_OVERRIDES = {}
+
+# Outside the try above, so a mistake in the rules stops the run instead of
+# quietly turning posting off
+CHANGE_RULES = changes.make_rules(CHANGE_OVERRIDES)
 
 DASHBOARD = "https://covid19.rpi.edu/dashboard"
+POLL_CACHE = ".cache_poll"
+SERIES_CACHE = ".cache_series"
+LEGACY_CACHE = ".cache"
+GRAPH_CACHE = ".cache_graphs"
+# Seconds before giving up on a dashboard that stopped responding
+FETCH_TIMEOUT = 30
+# How long a one-shot run lingers after posting for the archive to finish
+ARCHIVE_WAIT = 300
+GIT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".git")
+
+STATS_HEADER = "field field--name-field-stats field--type-entity-reference-revisions field--label-hidden field__items"
+STAT_HEADER = (
+    "field field--name-field-stat field--type-string field--label-hidden field__item"
+)
+CAPTION_HEADER = "field field--name-field-stats-caption field--type-string field--label-hidden field__item"
+
+# Where a dashboard keeps its numbers. The *_class entries are the class
+# attributes of the stats container, each stat and the caption (None if there
+# is none); an element matches if it has all of those classes. field_maps maps
+# how many stats were found to where each case_data field (see
+# normalize_case_data) comes from: an index into the stats, or None for 0.
+SiteProfile = namedtuple(
+    "SiteProfile",
+    [
+        "name",
+        "title",
+        "url",
+        "stats_class",
+        "stat_class",
+        "caption_class",
+        "field_maps",
+    ],
+)
+RPI = SiteProfile(
+    "rpi",
+    "RPI Covid Dashboard",
+    DASHBOARD,
+    STATS_HEADER,
+    STAT_HEADER,
+    CAPTION_HEADER,
+    # Daily layout as is, weekly has no separate daily number
+    {5: (0, 1, 2, 3, 4), 4: (0, 0, 1, 2, 3)},
+)
 
 
 class CovidData:
-    def __init__(self):
-        self.rpi_array = [0] * 5
-        self.historicalData = {}
+    def __init__(self, store=None):
+        # In-memory store unless we were handed one backed by SERIES_CACHE
+        self.store = TimeSeriesStore() if store is None else store
+        last = self.store.last()
+        self.rpi_array = [0] * 5 if last is None else last[1]
+        self._analytics = None
+
+    @property
+    def analytics(self):
+        # Serves every rolling/cumulative query. Built on first use, so runs
+        # that find nothing new never import NumPy, then kept current by update()
+        if self._analytics is None:
+            from analytics import Analytics
+
+            self._analytics = Analytics.from_store(self.store)
+        return self._analytics
+
+    @property
+    def historicalData(self):
+        # Full {date: case_data} view; loads the whole history, so avoid on hot paths
+        return dict(self.store.items())
+
+    def replace_history(self, history):
+        # Rewrites the whole {date: case_data} history (edits, backfills)
+        self.store.replace_all(history)
+        self._reload()
+
+    def checkpoint(self):
+        # What rollback() needs to undo the update()s made after this
+        return (len(self.store), self.store.last())
+
+    def rollback(self, checkpoint):
+        count, last = checkpoint
+        self.store.truncate(count)
+        if last is not None:
+            # update() may have re-recorded the latest day in place
+            self.store.append(*last)
+        self._reload()
+
+    def _reload(self):
+        # Re-derives everything else after the store was rewritten
+        last = self.store.last()
+        self.rpi_array = [0] * 5 if last is None else last[1]
+        self._analytics = None
 
     def update(self, case_data):
         today = date.today()
-        self.historicalData[today] = case_data
+        self.store.append(today, case_data)
+        if self._analytics is not None:
+            self._analytics.append(today, case_data)
         self.rpi_array = case_data
 
     def get_rolling(self):
-        return sum(self.get_rolling_iterator())
+        return self.get_rolling_sum()
 
     def get_case_data(self):
         return self.rpi_array
 
-    def get_rolling_iterator(self, day=date.today(), days=13):
-        dates = [day - timedelta(days=x) for x in range(days, -1, -1)]
-        return [
-            self.historicalData[date][0] if date in self.historicalData else 0
-            for date in dates
-        ]
+    def get_rolling_iterator(self, day=None, days=13):
+        day = date.today() if day is None else day
+        return self.analytics.daily_values(day - timedelta(days=days), day)
+
+    def get_rolling_sum(self, day=None, days=13):
+        # Same as sum(get_rolling_iterator(day, days)) without building the list
+        day = date.today() if day is None else day
+        return self.analytics.window_sum(day, days + 1)
+
+    def get_rolling_sums(self, start, end, days=13):
+        # get_rolling_sum() for every day from start through end, in one pass
+        return self.analytics.window_sums(start, end, days + 1)
+
+    def get_cumulative(self, start, end):
+        # Positives from start through end
+        return (self.analytics.cumulative(start, end) or [0])[-1]
 
     def get_last_update(self):
-        return (
-            None if len(self.historicalData) == 0 else max(self.historicalData.keys())
-        )
+        last = self.store.last()
+        return None if last is None else last[0]
 
 
-def check_for_updates():
+def load_poll_state(path=POLL_CACHE):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except:
+        return {
+            "etag": None,
+            "last_modified": None,
+            "hash": None,
+            "skipped": 0,
+            "parsed": 0,
+        }
+
+
+def save_poll_state(state, path=POLL_CACHE):
+    atomic_write(path, json.dumps(state))
+
+
+def extract_stats_block(html, profile=RPI):
+    # Slice out just the stats container and caption so we can fingerprint (and
+    # parse) them without touching the rest of the page.
+    # Returns None if the block isn't (fully) present in html yet, or if the
+    # profile has no caption to mark where the block ends.
+    if profile.caption_class is None:
+        return None
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    start = html.find(profile.stats_class.encode())
+    caption = html.find(profile.caption_class.encode(), start)
+    if start == -1 or caption == -1:
+        return None
+    end = html.find(b"</div>", caption)
+    if end == -1:
+        return None
+    start = max(html.rfind(b"<div", 0, start), 0)
+    return html[start : end + len(b"</div>")]
+
+
+def read_stats_block(request, chunk_size=16384, profile=RPI):
+    # Stream the response only until the stats block has arrived
+    buffer = b""
+    block = None
+    for chunk in request.iter_content(chunk_size=chunk_size):
+        buffer += chunk
+        block = extract_stats_block(buffer, profile)
+        if block is not None:
+            break
+    request.close()
+    return (buffer, block)
+
+
+def check_for_updates(poll_state=None, session=None, profile=None, timeout=None):
+    """
+    Fetches the dashboard and returns (data, caption), or None if the dashboard
+    is unchanged since the poll recorded in poll_state (which is updated in place).
+    Passing poll_state=None always does a full fetch and parse.
+    session is an optional requests.Session to reuse connections across polls.
+    profile is the SiteProfile to scrape, RPI's dashboard (DASHBOARD) by default.
+    """
+
     global DASHBOARD
-    request = requests.get(
-        DASHBOARD,
-        headers={
-            "User-Agent": "RPICovidScraper https://github.com/johnnyapol/RPICovidScraper"
-        },
-    )
-    soup = BeautifulSoup(request.text, features="lxml")
-    header = "field field--name-field-stats field--type-entity-reference-revisions field--label-hidden field__items"
-    header2 = "field field--name-field-stat field--type-string field--label-hidden field__item"
-    date_header = "field field--name-field-stats-caption field--type-string field--label-hidden field__item"
+    url = DASHBOARD if profile is None else profile.url
+    profile = RPI if profile is None else profile
+    timeout = FETCH_TIMEOUT if timeout is None else timeout
+    headers = {"User-Agent": USER_AGENT}
+    if poll_state is not None:
+        if poll_state.get("etag"):
+            headers["If-None-Match"] = poll_state["etag"]
+        if poll_state.get("last_modified"):
+            headers["If-Modified-Since"] = poll_state["last_modified"]
+
+    with metrics.span("fetch"):
+        request = (requests if session is None else session).get(
+            url, headers=headers, stream=True, timeout=timeout
+        )
+
+        if poll_state is not None and request.status_code == 304:
+            request.close()
+            metrics.count("dashboard_not_modified")
+            poll_state["skipped"] = poll_state.get("skipped", 0) + 1
+            return None
+        request.raise_for_status()
+        validators = {
+            "etag": request.headers.get("ETag"),
+            "last_modified": request.headers.get("Last-Modified"),
+        }
+
+        html, block = read_stats_block(request, profile=profile)
+    metrics.count("dashboard_bytes", len(html))
+    digest = None if block is None else hashlib.sha256(block).hexdigest()
+    if poll_state is not None and digest is not None:
+        if digest == poll_state.get("hash"):
+            metrics.count("dashboard_unchanged")
+            poll_state.update(validators)
+            poll_state["skipped"] = poll_state.get("skipped", 0) + 1
+            return None
+
+    with metrics.span("parse"):
+        try:
+            # Without a stats block (no caption in this profile) parse the whole page
+            block = html if block is None else block
+            result = parse_dashboard_stream([block], profile)
+        except:
+            print("Streaming dashboard parse failed, falling back to BeautifulSoup")
+            traceback.print_exc()
+            result = parse_dashboard(html, profile)
+
+    # Only remember this version once it parsed, so a broken page is refetched
+    if poll_state is not None:
+        poll_state.update(validators)
+        if digest is not None:
+            poll_state["hash"] = digest
+        poll_state["parsed"] = poll_state.get("parsed", 0) + 1
+    return result
 
+
+def parse_stat(text):
+    # Cleanup text (remove commas, all whitespace) so python can parse it
+    return int("".join(text.replace(",", "").split()))
+
+
+def normalize_case_data(data, profile=RPI):
     """
-        Current data format:
-
-        Daily:
-        case_data[0] = positive tests (last 24 hours)
-        case_data[1] = positive test results (last 7 days)
-        case_data[2] = positive test results (semester)
-        case_data[3] = total tests (last 7 days)
-        case_data[4] = total tests (semester)
-
-        Weekly:
-        case_data[0] = positive test results (last 7 days)
-        case_data[1] = positive test results (semester)
-        case_data[2] = total tests (last 7 days)
-        case_data[3] = total tests (semester)
+    Current data format:
+
+    Daily:
+    case_data[0] = positive tests (last 24 hours)
+    case_data[1] = positive test results (last 7 days)
+    case_data[2] = positive test results (semester)
+    case_data[3] = total tests (last 7 days)
+    case_data[4] = total tests (semester)
+
+    Weekly:
+    case_data[0] = positive test results (last 7 days)
+    case_data[1] = positive test results (semester)
+    case_data[2] = total tests (last 7 days)
+    case_data[3] = total tests (semester)
+
+    Weekly data has the weekly entry duplicated as the daily. Other dashboards
+    are mapped onto the daily format by their profile's field_maps.
     """
 
+    if len(data) not in profile.field_maps:
+        raise ValueError(f"{profile.name}: unexpected stats layout {data}")
+    return [0 if i is None else data[i] for i in profile.field_maps[len(data)]]
+
+
+def parse_dashboard(html, profile=RPI):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, features="lxml")
     data = [
-        # Cleanup text (remove commas, all whitespace) so python can parse it
-        int("".join(x.text.replace(",", "").split()))
-        for x in soup.find("div", {"class": header}).findAll("div", {"class": header2})
+        parse_stat(x.text)
+        for x in soup.find(attrs={"class": profile.stats_class}).findAll(
+            attrs={"class": profile.stat_class}
+        )
     ]
-    caption = soup.find("div", {"class": date_header}).text
-    # Weekly
-    if len(data) == 4:
-        # Quick hack to duplicate the weekly entry as the daily
-        data.insert(0, data[0])
-    return (data, caption)
+    caption = ""
+    if profile.caption_class is not None:
+        caption = soup.find(attrs={"class": profile.caption_class}).text
+    return (normalize_case_data(data, profile), caption)
+
+
+class DashboardTarget:
+    """
+    lxml parser target that collects the stat and caption divs as the parser
+    emits events, without building a tree. done is set once the caption (or,
+    for profiles without one, the stats container) closes.
+    """
+
+    def __init__(self, profile=RPI):
+        self.stats_classes = set(profile.stats_class.split())
+        self.stat_classes = set(profile.stat_class.split())
+        self.caption_classes = None
+        if profile.caption_class is not None:
+            self.caption_classes = set(profile.caption_class.split())
+        self.stats = []
+        self.caption = None
+        self.done = False
+        self._container_depth = 0
+        self._depth = 0
+        self._capture = None
+        self._capture_depth = 0
+        self._text = []
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        classes = set(attrib.get("class", "").split())
+        if self._capture is not None or self.done:
+            return
+        if self._container_depth == 0 and self.stats_classes <= classes:
+            self._container_depth = self._depth
+        elif self._container_depth and self.stat_classes <= classes:
+            self._capture, self._capture_depth, self._text = "stat", self._depth, []
+        elif self.caption_classes is not None and self.caption_classes <= classes:
+            self._capture, self._capture_depth, self._text = "caption", self._depth, []
+
+    def end(self, tag):
+        if self._capture is not None and self._depth == self._capture_depth:
+            text = "".join(self._text)
+            if self._capture == "stat":
+                self.stats.append(parse_stat(text))
+            else:
+                self.caption = text
+                self.done = True
+            self._capture = None
+        elif self._depth == self._container_depth:
+            self._container_depth = 0
+            if self.caption_classes is None:
+                self.caption = ""
+                self.done = True
+        self._depth -= 1
+
+    def data(self, data):
+        if self._capture is not None:
+            self._text.append(data)
+
+    def close(self):
+        return (self.stats, self.caption)
+
+
+def parse_dashboard_stream(chunks, profile=RPI):
+    # Deferred so a missing lxml only disables this backend
+    from lxml import etree
+
+    target = DashboardTarget(profile)
+    parser = etree.HTMLParser(target=target)
+    for chunk in chunks:
+        parser.feed(chunk)
+        if target.done:
+            break
+    else:
+        parser.close()
+
+    if not target.done or len(target.stats) not in profile.field_maps:
+        raise ValueError(f"Dashboard stats not found (got {target.stats})")
+    return (normalize_case_data(target.stats, profile), target.caption)
 
 
 def case_value_to_string(case_data, previous_case_data, index):
@@ -121,17 +425,50 @@ def case_value_to_string(case_data, previous_case_data, index):
     return f"{case_data[index]:,} {diff_string}"
 
 
+def read_git_head(git_dir=GIT_DIR):
+    # Resolve HEAD to a commit hash straight from .git instead of forking git
+    with open(os.path.join(git_dir, "HEAD"), "r") as file:
+        head = file.read().strip()
+    if not head.startswith("ref: "):
+        # Detached HEAD
+        return head
+    ref = head[len("ref: ") :]
+    try:
+        with open(os.path.join(git_dir, ref), "r") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        with open(os.path.join(git_dir, "packed-refs"), "r") as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    raise ValueError(f"Could not resolve {ref}")
+
+
+@lru_cache(maxsize=None)
 def get_source_url():
     start = "https://github.com/johnnyapol/RPICovidScraper/"
     try:
-        return f'{start}commit/{run(["git", "log", "--pretty=format:%H", "-n", "1"], capture_output=True).stdout.decode("ascii")}'
+        return f"{start}commit/{read_git_head()}"
     except:
         return start
 
 
 def post_discord(
-    rolling, old_rolling, case_data, previous_case_data, date, dashboard_url, graph
+    rolling,
+    old_rolling,
+    case_data,
+    previous_case_data,
+    date,
+    dashboard_url,
+    graph,
+    stats=None,
+    alerts=(),
+    title=RPI.title,
+    session=None,
 ):
+    # stats (analytics.DayStats) and alerts (Analytics.alerts()) describe today.
+    # session is the caller's pooled session, if it has one to share
     global WEBHOOKS
     global PSA
     global QUIET
@@ -162,6 +499,9 @@ def post_discord(
     if QUIET and case_data[0] == 0:
         return
 
+    from discord_webhook import DiscordEmbed, DiscordWebhook
+    from webhooks import deliver_all, print_results
+
     embed = DiscordEmbed()
 
     if case_data[0] > 4:
@@ -178,6 +518,17 @@ def post_discord(
         embed.add_embed_field(name="ANNOUNCEMENT", value=PSA, inline=False)
         embed.color = 15844367
 
+    if alerts:
+        embed.add_embed_field(
+            name="TRIGGER POINT",
+            value="\n".join(
+                f"{'Crossed' if above else 'Back below'}: {trigger.name}"
+                for trigger, above in alerts
+            ),
+            inline=False,
+        )
+        embed.set_color(15158332)
+
     embed.add_embed_field(
         name="New Positive Tests",
         value=f"{case_data[0]}",
@@ -201,9 +552,16 @@ def post_discord(
         inline=False,
     )
     if case_data[1] != 0:
-        # Calculate weekly positivity rate
-        pcr = (case_data[1] / case_data[3]) * 100
+        if stats is not None and stats.positivity is not None:
+            pcr = stats.positivity
+        else:
+            # Calculate weekly positivity rate
+            pcr = (case_data[1] / case_data[3]) * 100
         embed.add_embed_field(name="Weekly Positivity Rate", value=f"{round(pcr, 4)}%")
+    if stats is not None and stats.growth is not None:
+        embed.add_embed_field(
+            name="Week over Week", value=f"{stats.growth:+.1f}% new positives"
+        )
     embed.add_embed_field(
         name="Total Positive Tests",
         value=case_value_to_string(case_data, previous_case_data, 2),
@@ -223,142 +581,283 @@ def post_discord(
     )
 
     hook = DiscordWebhook(
-        url=WEBHOOKS,
+        url=None,
         content=choice(
             [
-                "The RPI Covid Dashboard has been updated!",
+                f"The {title} has been updated!",
                 "I got yer COVID data right here!",
                 "Special delivery!",
                 "Beep beep boop",
                 "I found some data!",
             ]
         ),
-        username="RPI Covid Dashboard",
+        username=title,
         avatar_url="https://www.minnpost.com/wp-content/uploads/2020/03/coronavirusCDC640.png",
     )
 
+    files = []
     if graph != None:
-        hook.add_file(file=graph.read(), filename="graph.png")
+        files.append(("graph.png", graph.read()))
         embed.set_image(url="attachment://graph.png")
     hook.add_embed(embed)
-    hook.execute()
 
+    # Render the message once and fan it out to every server in parallel
+    results = deliver_all(WEBHOOKS, hook.json, files, session)
+    print_results(results)
+    return results
 
-def load_previous():
-    try:
-        with open(".cache", "rb") as file:
-            return pickle.load(file)
-    except:
-        print("Cache read failed")
-        return CovidData()
+
+def load_previous(path=SERIES_CACHE):
+    # Holds the store's lock until it's closed (or the process exits). An
+    # unreadable or locked cache is an error: carrying on with an empty history
+    # would post wrong numbers
+    legacy = path == SERIES_CACHE and os.path.exists(LEGACY_CACHE)
+    if legacy and not os.path.exists(SERIES_CACHE):
+        # One-time migration from the old pickled CovidData, which is left in place
+        print(f"Migrating {LEGACY_CACHE} to {SERIES_CACHE}")
+        return CovidData(migrate_pickle(LEGACY_CACHE, SERIES_CACHE))
+    return CovidData(TimeSeriesStore(path))
 
 
 def save(case_data):
-    with open(".cache", "wb") as file:
-        pickle.dump(case_data, file)
+    # Records are appended by CovidData.update(), this just makes them durable
+    case_data.store.flush()
 
 
 def create_graph(data, days=13):
-    x = [int(z) for z in data.get_rolling_iterator(days=days)]
-    cum = [x[0]]
-    for i in range(1, len(x)):
-        cum.append(cum[-1] + x[i])
-    # thanks to https://www.tutorialspoint.com/matplotlib/matplotlib_bar_plot.htm for help
-    today = date.today()
-    monthday = lambda d: f"{d.month}-{d.day}"
-    dates = [today - timedelta(days=x) for x in range(days, -1, -1)]
-    plot.title(f"Previous {days+1} days")
-    plot.bar(dates, x, color="red", label="Daily positive tests")
-    plot.plot(dates, cum, color="orange", label=f"Positives since {monthday(dates[0])}")
-    # Add individual day labels
-    for i, v in zip(dates, x):
-        if v == 0:
-            continue
-        plot.text(i, v, str(v), color="blue", fontweight="bold", ha="center")
-    plot.plot(
-        dates,
-        [sum(data.get_rolling_iterator(date)) for date in dates],
-        color="green",
-        label="Rolling 2 week sum",
-    )
-    plot.xticks(dates, [monthday(date) for date in dates], rotation=45)
-    plot.legend()
-
-    data = BytesIO()
-    plot.subplots_adjust(bottom=0.17)
-    plot.ylabel("Number of positive tests")
-    plot.xlabel("Day reported")
-    now = datetime.now()
-    plot.figtext(
-        0.5,
-        0.01,
-        f"Generated on {now.strftime('%m/%d/%y %H:%M')} {datetime.now().astimezone().tzinfo.tzname(None)}",
-        ha="center",
-        fontsize=8,
-    )
-    plot.savefig(data, format="png")
-    data.seek(0)
-    return data
+    from renderer import get_renderer, graph_inputs
 
+    inputs = graph_inputs(data, date.today(), days)
+    return BytesIO(get_renderer(GRAPH_CACHE).render(inputs))
 
-def main():
-    global DASHBOARD
-    covid_data = load_previous()
-    previous_case_data = deepcopy(covid_data.get_case_data())
-    current_case_data, date = check_for_updates()
 
-    ci = any(x.lower() == "--ci" for x in sys.argv)
-    force = any(x.lower() == "--force" for x in sys.argv)
+def start_graph(data, days=13):
+    # Same as create_graph(), but drawn in a worker process; returns a Future
+    from renderer import graph_inputs, render_in_background
 
-    # Only post under the following conditions:
-    # 1. There is new data from RPI
-    #           - AND -
-    # 2. there are new positive tests OR new weekly/total numbers reported
-    # This avoids the bs updates where all RPI does is reset the daily/weekly numbers
-    if (
-        force
-        or current_case_data != previous_case_data
-        and (
-            current_case_data[0] != 0
-            or any(
-                current_case_data[x] != previous_case_data[x]
-                for x in range(2, len(current_case_data))
-            )
-        )
-    ):
-        dashboard_url = DASHBOARD
+    return render_in_background(graph_inputs(data, date.today(), days), GRAPH_CACHE)
+
+
+def link_archive(archive_url, messages):
+    # Edits each post to point at the archived dashboard
+    from webhooks import create_session, edit_message
+
+    session = create_session(pool_size=1)
+    for url, message_id, content in messages:
         try:
-            # We don't want to abuse the Wayback Machine in actions
-            if not ci:
-                dashboard_url = savepagenow.capture(DASHBOARD, accept_cache=True)
-            else:
-                print("Skipping page archive as we are running in CI mode")
+            edit_message(
+                session,
+                url,
+                message_id,
+                {"content": f"{content}\nArchived dashboard: {archive_url}"},
+            )
         except:
-            print(f"Page archived failed")
+            print("Editing a Discord message failed")
             traceback.print_exc()
+    session.close()
+
+
+def start_archiving(archive):
+    # Works through this and any earlier unfinished captures in the background
+    from archiver import start_background
+
+    start_background(archive, follow_up=link_archive)
+
 
-        last_update = covid_data.get_last_update()
-        if last_update is None:
-            old_rolling = 0
+def record_update_time(poll_state, when, keep=60):
+    # Remember when RPI publishes so the daemon can learn its schedule
+    times = poll_state.setdefault("update_times", [])
+    times.append(when.isoformat(timespec="minutes"))
+    del times[:-keep]
+
+
+def publish(
+    covid_data,
+    current_case_data,
+    previous_case_data,
+    date,
+    dashboard,
+    title=RPI.title,
+    ci=False,
+    render_in_worker=False,
+    session=None,
+):
+    # Records, posts, archives and saves one update that poll() decided to post.
+    # render_in_worker draws the graph in a worker process: the daemons' other
+    # threads (other sites' polls, the archiver) keep going meanwhile, whereas
+    # a one-shot run has nothing to overlap it with and draws it inline
+    last_update = covid_data.get_last_update()
+    if last_update is None:
+        old_rolling = 0
+    else:
+        old_rolling = covid_data.get_rolling_sum(day=last_update)
+    covid_data.update(current_case_data)
+    today = covid_data.get_last_update()
+    analytics = covid_data.analytics
+
+    # Identical dashboard content is only ever archived once
+    content_hash = hashlib.sha256(
+        repr((dashboard, current_case_data, date)).encode("utf-8")
+    ).hexdigest()
+    archive = None
+    dashboard_url = dashboard
+    # We don't want to abuse the Wayback Machine in actions
+    if not ci:
+        from archiver import get_queue
+
+        archive = get_queue()
+        dashboard_url = archive.archived_url(content_hash) or dashboard
+    else:
+        print("Skipping page archive as we are running in CI mode")
+
+    try:
+        if render_in_worker:
+            # The whole draw unless it was cached; only this thread waits on it
+            with metrics.span("render_wait"):
+                graph = BytesIO(start_graph(covid_data).result())
         else:
-            old_rolling = sum(covid_data.get_rolling_iterator(day=last_update))
-        covid_data.update(current_case_data)
+            graph = create_graph(covid_data)
+    except:
+        print("Graph rendering failed")
+        traceback.print_exc()
+        graph = None
 
-        post_discord(
+    with metrics.span("post"):
+        results = post_discord(
             covid_data.get_rolling(),
             old_rolling,
             current_case_data,
             previous_case_data,
             date,
             dashboard_url,
-            create_graph(covid_data),
+            graph,
+            analytics.at(today),
+            analytics.alerts(today),
+            title,
+            session,
         )
 
+    if archive is not None and dashboard_url == dashboard:
+        # Posted with the live link; swap in the archived copy once it exists
+        messages = [
+            (result.url, result.message["id"], result.message.get("content", ""))
+            for result in results or []
+            if result.error is None and result.message
+        ]
+        archive.enqueue(dashboard, content_hash, messages)
+    if archive is not None:
+        start_archiving(archive)
+
+    with metrics.span("save"):
         save(covid_data)
+
+
+def poll(
+    covid_data,
+    poll_state,
+    ci=False,
+    force=False,
+    session=None,
+    now=None,
+    profile=None,
+    render_in_worker=False,
+):
+    """
+    Runs one dashboard poll against covid_data/poll_state (both updated in place),
+    posting and saving covid_data if there is something new. Returns True if the
+    dashboard had new numbers (changes.NEW) or the update was posted; resets and
+    reverts that aren't posted don't count, so they don't teach the scheduler a
+    publish time or cut its back-off short. Persisting poll_state is left to
+    the caller. If it raises, covid_data is unchanged but poll_state may not
+    be: callers that carry on should poll against a copy and only keep it once
+    poll() returns.
+    profile selects the dashboard (a SiteProfile), RPI's by default.
+    session (also used for the post) and render_in_worker are passed on to
+    publish().
+    """
+
+    global DASHBOARD
+    dashboard = DASHBOARD if profile is None else profile.url
+    title = RPI.title if profile is None else profile.title
+    previous_case_data = deepcopy(covid_data.get_case_data())
+
+    # --force always does a full fetch so there is something to post
+    update = check_for_updates(None if force else poll_state, session, profile)
+    print(
+        f"Dashboard polls: {poll_state.get('parsed', 0)} parsed, "
+        f"{poll_state.get('skipped', 0)} skipped"
+    )
+    if update is None:
+        print("Dashboard unchanged since last poll, nothing to do")
+        return False
+    current_case_data, date = update
+
+    # Only new data is posted by default: not the updates where all RPI does is
+    # reset the daily/weekly numbers, nor the dashboard flipping back to
+    # numbers it showed a few polls ago. Decided before anything expensive runs
+    change = changes.classify(
+        current_case_data,
+        previous_case_data,
+        poll_state.get("snapshots", []),
+        CHANGE_RULES,
+    )
+    changes.remember(poll_state, current_case_data, CHANGE_RULES)
+    metrics.count(f"change_{change.kind}")
+    print(f"Dashboard change: {changes.describe(change)}")
+    new = change.kind == changes.NEW
+    if new:
+        record_update_time(poll_state, datetime.now() if now is None else now)
+    posted = force or change.kind in CHANGE_RULES.post
+    if posted:
+        # On failure covid_data goes back to how it was, so the next poll (with
+        # the caller's old poll_state) handles the update again
+        checkpoint = covid_data.checkpoint()
+        try:
+            publish(
+                covid_data,
+                current_case_data,
+                previous_case_data,
+                date,
+                dashboard,
+                title,
+                ci,
+                render_in_worker,
+                session,
+            )
+        except:
+            covid_data.rollback(checkpoint)
+            raise
     print(
         f"Done. Old: {previous_case_data} New: {current_case_data}\n Rolling: {covid_data.get_rolling()}"
     )
+    return new or posted
+
+
+def main():
+    ci = any(x.lower() == "--ci" for x in sys.argv)
+    force = any(x.lower() == "--force" for x in sys.argv)
+
+    covid_data = load_previous()
+    try:
+        poll_state = load_poll_state()
+        poll(covid_data, poll_state, ci, force)
+        # Only remember the fingerprint once the update has been handled
+        save_poll_state(poll_state)
+    finally:
+        # Lets the next run in now rather than after the archive wait below
+        covid_data.store.close()
+
+    # Everything is posted already; give the archive a chance to finish
+    # (anything left over stays queued for the next run)
+    from archiver import wait_for_background
+
+    wait_for_background(ARCHIVE_WAIT)
 
 
 if __name__ == "__main__":
-    main()
+    # --profile writes a cProfile dump next to the run report
+    if any(x.lower() == "--profile" for x in sys.argv):
+        metrics.profiled(main)
+    else:
+        main()
+    metrics.RUN.write()
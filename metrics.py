@@ -0,0 +1,129 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from state import atomic_write
+
+REPORT_PATH = ".run_report.json"
+PREFIX = "rpicovid"
+
+
+class Metrics:
+    """
+    Per-run timings and counters. span(name) times a stage (repeated spans
+    of the same name add up), count(name, n) bumps a counter. Safe to use
+    from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        # name -> [calls, total seconds, longest call]
+        self.spans = {}
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration": time.perf_counter() - self._start,
+                "spans": {
+                    name: {"calls": calls, "seconds": total, "max_seconds": longest}
+                    for name, (calls, total, longest) in sorted(self.spans.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self, prefix=PREFIX):
+        # Text exposition format, e.g. for node_exporter's textfile collector
+        report = self.report()
+        lines = [
+            f"# HELP {prefix}_run_duration_seconds Wall time of the run so far",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration']:.6f}",
+            f"# HELP {prefix}_run_started_seconds When the run started",
+            f"# TYPE {prefix}_run_started_seconds gauge",
+            f"{prefix}_run_started_seconds {report['started']:.3f}",
+        ]
+        for metric, key, help in [
+            ("stage_seconds_total", "seconds", "Time spent in each stage"),
+            ("stage_calls_total", "calls", "Times each stage ran"),
+            ("stage_max_seconds", "max_seconds", "Longest single run of each stage"),
+        ]:
+            kind = "gauge" if key == "max_seconds" else "counter"
+            lines += [
+                f"# HELP {prefix}_{metric} {help}",
+                f"# TYPE {prefix}_{metric} {kind}",
+            ]
+            lines += [
+                f'{prefix}_{metric}{{stage="{name}"}} {span[key]}'
+                for name, span in report["spans"].items()
+            ]
+        for name, value in report["counters"].items():
+            lines += [
+                f"# TYPE {prefix}_{name}_total counter",
+                f"{prefix}_{name}_total {value}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=REPORT_PATH):
+        # Writes path and a .prom file beside it
+        prometheus = f"{os.path.splitext(path)[0]}.prom"
+        for target, content in [
+            (path, json.dumps(self.report(), indent=1)),
+            (prometheus, self.prometheus()),
+        ]:
+            atomic_write(target, content)
+
+
+# Shared by everything in the process
+RUN = Metrics()
+span = RUN.span
+count = RUN.count
+
+
+def profiled(func, path=REPORT_PATH):
+    """
+    Runs func() under cProfile and dumps the profile next to the run report
+    (view it with python -m pstats). Returns what func returned.
+    """
+
+    import cProfile
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func)
+    finally:
+        profile.dump_stats(f"{os.path.splitext(path)[0]}.prof")
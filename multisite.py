@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# Usage: ./multisite.py [--ci]
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import signal
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from daemon import PollScheduler
+from main import (
+    POLL_CACHE,
+    RPI,
+    SERIES_CACHE,
+    SiteProfile,
+    load_poll_state,
+    load_previous,
+    poll,
+    save_poll_state,
+)
+from webhooks import HostRateLimiter, create_session
+
+# Extra dashboards come from config.SITES, a list of dicts of SiteProfile fields
+try:
+    import config
+
+    SITES = [RPI] + [SiteProfile(**site) for site in getattr(config, "SITES", [])]
+except ImportError:
+    SITES = [RPI]
+
+MAX_WORKERS = 8
+# Seconds between requests to the same host, however many sites live there
+PER_HOST_INTERVAL = 2.0
+
+
+def cache_paths(profile):
+    # (series cache, poll cache); RPI keeps the paths main.py has always used
+    if profile.name == RPI.name:
+        return (SERIES_CACHE, POLL_CACHE)
+    return (f"{SERIES_CACHE}_{profile.name}", f"{POLL_CACHE}_{profile.name}")
+
+
+class Site:
+    # One tracked dashboard and everything kept between its polls
+    def __init__(self, profile, covid_data=None, poll_state=None, scheduler=None):
+        series_cache, self.poll_cache = cache_paths(profile)
+        self.profile = profile
+        if covid_data is None:
+            covid_data = load_previous(series_cache)
+        self.covid_data = covid_data
+        if poll_state is None:
+            poll_state = load_poll_state(self.poll_cache)
+        self.poll_state = poll_state
+        self.scheduler = PollScheduler() if scheduler is None else scheduler
+        self.failures = 0
+        self.next_poll = None
+
+    def schedule(self, now, result):
+        # Failed polls back off on their own, without touching the learned schedule
+        if isinstance(result, Exception):
+            self.failures += 1
+            interval = min(
+                self.scheduler.default_interval * 2 ** (self.failures - 1),
+                self.scheduler.max_interval,
+            )
+        else:
+            self.failures = 0
+            interval = self.scheduler.next_interval(
+                now, self.poll_state.get("update_times", []), result
+            )
+        self.next_poll = now + timedelta(seconds=interval)
+
+
+def poll_site(site, session, limiter, ci=False, now=None):
+    limiter.wait(site.profile.url)
+    # Kept only if the poll goes through, like run_daemon() does: otherwise
+    # run_sites() would save a fingerprint for an update that was never posted
+    poll_state = deepcopy(site.poll_state)
+    changed = poll(
+        site.covid_data,
+        poll_state,
+        ci,
+        session=session,
+        now=now,
+        profile=site.profile,
+        render_in_worker=True,
+    )
+    site.poll_state = poll_state
+    if changed:
+        save_poll_state(site.poll_state, site.poll_cache)
+    return changed
+
+
+def poll_sites(sites, session, limiter, ci=False, now=None, max_workers=MAX_WORKERS):
+    """
+    Polls sites concurrently over one pooled session. A site that fails (bad
+    markup, timeouts, HTTP errors) is reported and doesn't hold up the rest.
+    Returns {site name: whether its dashboard changed, or the exception}.
+    """
+
+    def run(site):
+        try:
+            return poll_site(site, session, limiter, ci, now)
+        except Exception as e:
+            print(f"{site.profile.name}: poll failed")
+            traceback.print_exc()
+            return e
+
+    if not sites:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(sites))) as pool:
+        return dict(zip((site.profile.name for site in sites), pool.map(run, sites)))
+
+
+def run_sites(sites, ci=False, now=None, wait=None, max_rounds=None):
+    """
+    Polls every site on its own schedule until SIGTERM/SIGINT; sites that are
+    due at the same time are polled together. now() and wait(seconds) work
+    as in daemon.run_daemon().
+    """
+
+    now = datetime.now if now is None else now
+    stop = threading.Event()
+    wait = stop.wait if wait is None else wait
+
+    def shutdown(signum, frame):
+        print(f"Got signal {signum}, shutting down after this round")
+        stop.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+    session = create_session(pool_size=MAX_WORKERS)
+    limiter = HostRateLimiter(PER_HOST_INTERVAL)
+    rounds = 0
+    try:
+        while not stop.is_set() and (max_rounds is None or rounds < max_rounds):
+            current = now()
+            due = [
+                site
+                for site in sites
+                if site.next_poll is None or site.next_poll <= current
+            ]
+            results = poll_sites(due, session, limiter, ci, current)
+            for site in due:
+                site.schedule(now(), results[site.profile.name])
+            rounds += 1
+
+            upcoming = min(site.next_poll for site in sites)
+            print(f"Next poll at {upcoming}")
+            wait(max((upcoming - now()).total_seconds(), 0))
+    finally:
+        for site in sites:
+            save_poll_state(site.poll_state, site.poll_cache)
+            site.covid_data.store.close()
+        session.close()
+    return rounds
+
+
+if __name__ == "__main__":
+    run_sites(
+        [Site(profile) for profile in SITES],
+        ci=any(x.lower() == "--ci" for x in sys.argv),
+    )
@@ -0,0 +1,200 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import metrics
+from state import atomic_write
+
+# Everything the graph depends on, as plain picklable values
+GraphInputs = namedtuple(
+    "GraphInputs", ["days", "dates", "daily", "cumulative", "rolling", "generated"]
+)
+
+
+def graph_inputs(data, today, days=13):
+    dates = [today - timedelta(days=x) for x in range(days, -1, -1)]
+    now = datetime.now()
+    analytics = data.analytics
+    return GraphInputs(
+        days,
+        dates,
+        analytics.daily_values(dates[0], today),
+        analytics.cumulative(dates[0], today),
+        analytics.window_sums(dates[0], today),
+        f"Generated on {now.strftime('%m/%d/%y %H:%M')} {now.astimezone().tzinfo.tzname(None)}",
+    )
+
+
+def cache_key(inputs):
+    # The generated timestamp is deliberately left out: same data, same graph
+    return hashlib.sha256(repr(inputs[:-1]).encode("utf-8")).hexdigest()
+
+
+class GraphRenderer:
+    """
+    Draws the case graph onto one explicit Agg Figure that is cleared and reused
+    between renders, instead of pyplot's global state. PNG output is cached by
+    cache_key() in memory, and on disk under cache_dir if one is given.
+    The cache may be shared between threads; drawing may not.
+    """
+
+    def __init__(self, cache_dir=None, cache_size=32):
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._figure = None
+
+    def _get_figure(self):
+        if self._figure is None:
+            # Deferred so runs that never draw don't pay for matplotlib
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+
+            self._figure = Figure()
+            FigureCanvasAgg(self._figure)
+        self._figure.clear()
+        return self._figure
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def cached(self, inputs):
+        key = cache_key(inputs)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if self.cache_dir is not None and os.path.exists(self._cache_path(key)):
+                with open(self._cache_path(key), "rb") as file:
+                    return self._remember(key, file.read(), False)
+        return None
+
+    def _remember(self, key, png, persist=True):
+        with self._lock:
+            self._cache[key] = png
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            if persist and self.cache_dir is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                atomic_write(self._cache_path(key), png)
+                self._prune()
+        return png
+
+    def _prune(self):
+        files = sorted(
+            (os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)),
+            key=os.path.getmtime,
+        )
+        for path in files[: -self.cache_size]:
+            os.remove(path)
+
+    def render(self, inputs):
+        png = self.cached(inputs)
+        if png is not None:
+            metrics.count("render_cache_hits")
+            return png
+        with metrics.span("render"):
+            png = self.draw(inputs)
+        return self._remember(cache_key(inputs), png)
+
+    def draw(self, inputs, format="png"):
+        days, dates, x, cum, rolling, generated = inputs
+        # thanks to https://www.tutorialspoint.com/matplotlib/matplotlib_bar_plot.htm for help
+        monthday = lambda d: f"{d.month}-{d.day}"
+        figure = self._get_figure()
+        axes = figure.add_subplot()
+        axes.set_title(f"Previous {days+1} days")
+        axes.bar(dates, x, color="red", label="Daily positive tests")
+        axes.plot(
+            dates, cum, color="orange", label=f"Positives since {monthday(dates[0])}"
+        )
+        # Add individual day labels
+        for i, v in zip(dates, x):
+            if v == 0:
+                continue
+            axes.text(i, v, str(v), color="blue", fontweight="bold", ha="center")
+        axes.plot(dates, rolling, color="green", label="Rolling 2 week sum")
+        axes.set_xticks(dates)
+        axes.set_xticklabels([monthday(date) for date in dates], rotation=45)
+        axes.legend()
+
+        figure.subplots_adjust(bottom=0.17)
+        axes.set_ylabel("Number of positive tests")
+        axes.set_xlabel("Day reported")
+        figure.text(0.5, 0.01, generated, ha="center", fontsize=8)
+
+        data = BytesIO()
+        # No creation date, so the same inputs always give the same file
+        metadata = {"Date": None} if format == "svg" else None
+        figure.savefig(data, format=format, metadata=metadata)
+        return data.getvalue()
+
+
+_renderer = None
+_pool = None
+_lock = threading.Lock()
+
+
+def get_renderer(cache_dir=None):
+    global _renderer
+    with _lock:
+        if _renderer is None:
+            _renderer = GraphRenderer(cache_dir)
+    return _renderer
+
+
+def _render_in_worker(inputs):
+    # Runs in the worker process, which keeps its own Figure between calls.
+    # Its metrics aren't ours, so the draw time is sent back with the PNG
+    start = time.perf_counter()
+    png = get_renderer().draw(inputs)
+    return (png, time.perf_counter() - start)
+
+
+def render_in_background(inputs, cache_dir=None):
+    """
+    Starts rendering in a worker process so it overlaps with network work.
+    Returns a Future resolving to the PNG bytes (immediately, on a cache hit).
+    """
+
+    global _pool
+    renderer = get_renderer(cache_dir)
+    png = renderer.cached(inputs)
+    if png is not None:
+        metrics.count("render_cache_hits")
+        future = Future()
+        future.set_result(png)
+        return future
+
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=1)
+    worker = _pool.submit(_render_in_worker, inputs)
+    future = Future()
+
+    def done(worker):
+        try:
+            png, seconds = worker.result()
+        except BaseException as e:
+            return future.set_exception(e)
+        metrics.RUN.observe("render", seconds)
+        future.set_result(renderer._remember(cache_key(inputs), png))
+
+    worker.add_done_callback(done)
+    return future
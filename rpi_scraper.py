@@ -1,44 +1,157 @@
+import hashlib
 import re
+import sys
+import textwrap
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from bs4 import BeautifulSoup
 import html2text
+from lxml import html as lxml_html
 import requests
 
+from announcement_cache import AnnouncementCache
+import metrics
+import webhooks
+from webhooks import HostRateLimiter, fetch
+
+# Announcements go to the same webhooks as the dashboard updates (see main.py)
+try:
+    import config
+
+    WEBHOOKS = config.webhooks
+except:
+    WEBHOOKS = None
 
 MAX_MESSAGE_LEN = 2000
 HOME_URL = "https://covid19.rpi.edu"
+MAX_WORKERS = 8
+# Announcements are listed newest first, so stop reading the listing after this
+# many consecutive links we've already seen
+SEEN_RUN = 5
+# Long announcements are split into parts this long, so that two (and their
+# footers) fit in one message under Discord's MAX_EMBED_TOTAL
+PART_LEN = webhooks.MAX_EMBED_TOTAL // 2 - 100
+# Timings and counters from the last run (see metrics.py)
+REPORT_PATH = ".run_report_announcements.json"
+
+# announcement_data is None when the page is unchanged since the last committed
+# crawl, or couldn't be fetched (error is then the exception)
+PageResult = namedtuple("PageResult", ["path", "announcement_data", "edited", "error"])
 
 
 def construct_url(path):
     return HOME_URL + path
 
 
-def collect_communications_paths():
+def collect_communications_paths(session=None, limiter=None, cache=None, stats=None):
+    """
+    Announcement paths from the communications listing. With a cache, the
+    listing is fetched conditionally and scanning stops after SEEN_RUN
+    already-seen links in a row. If the listing is unchanged, the SEEN_RUN
+    most recently seen paths are returned instead: editing an announcement
+    doesn't change the listing, but crawl_updates() should still re-check it.
+    """
+
     paths = []
-    soup = create_soup("/communications")
+    url = construct_url("/communications")
+    page = None if cache is None else cache.page(url)
+    soup, validators = fetch_soup("/communications", session, limiter, page, stats)
+    if soup is None:
+        return cache.recent(SEEN_RUN)
+    if cache is not None:
+        cache.stage_page(url, *validators, None)
+    seen_run = 0
     for link in soup.findAll("a", attrs={"href": re.compile("announcements")}):
-        paths.append(link.get("href"))
+        path = link.get("href")
+        if path in paths:
+            continue
+        paths.append(path)
+        if cache is not None:
+            seen_run = seen_run + 1 if path in cache else 0
+            if seen_run >= SEEN_RUN:
+                break
     return paths
 
 
-def filter_paths(paths):
-    with open(".cache_sample", "r") as f:
-        cache_paths = f.readlines()
-    already_processed_paths = [path.rstrip("\n") for path in cache_paths]
-    return [path for path in paths if path not in already_processed_paths]
+def filter_paths(paths, cache=None):
+    cache = AnnouncementCache() if cache is None else cache
+    return cache.filter_new(paths)
+
+
+def update_cache(paths, cache=None):
+    # All or nothing: either every path is marked seen or none are
+    cache = AnnouncementCache() if cache is None else cache
+    cache.mark_seen(paths)
+
+
+class CrawlStats:
+    # Per-run counters, shared by the crawler threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_downloaded = 0
+        self.not_modified = 0
+        self.pages_parsed = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+                metrics.count(f"crawl_{name}", count)
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests, {self.bytes_downloaded:,} bytes downloaded, "
+            f"{self.not_modified} not modified, {self.pages_parsed} pages parsed"
+        )
 
 
-def update_cache(paths):
-    with open(".cache_sample", "a") as f:
-        lines = [path + "\n" for path in paths]
-        f.writelines(lines)
+def conditional_headers(page):
+    if page is None:
+        return {}
+    etag, last_modified, _ = page
+    headers = {"If-None-Match": etag, "If-Modified-Since": last_modified}
+    return {name: value for name, value in headers.items() if value}
 
 
-def create_soup(path):
+def fetch_page(path, session=None, limiter=None, page=None, stats=None):
+    """
+    Conditional GET of path: page is the stored (etag, last_modified,
+    fingerprint) of the last fetch, if any. Returns (html, (etag,
+    last_modified)), with html None if the server said 304. Error responses
+    raise requests.HTTPError.
+    """
+
     url = construct_url(path)
-    html = requests.get(url).text
+    response = fetch(url, session, limiter, headers=conditional_headers(page))
+    if stats is not None:
+        stats.add(requests=1, bytes_downloaded=len(response.content))
+    validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    if response.status_code == 304:
+        if stats is not None:
+            stats.add(not_modified=1)
+        return (None, validators)
+    # fetch() hands back the last 5xx once it runs out of retries, and error
+    # pages aren't announcements
+    response.raise_for_status()
+    return (response.text, validators)
+
+
+def fetch_soup(path, session=None, limiter=None, page=None, stats=None):
+    # fetch_page(), parsed with BeautifulSoup
+    html, validators = fetch_page(path, session, limiter, page, stats)
+    if html is None:
+        return (None, validators)
     soup = BeautifulSoup(html, features="lxml")
-    return soup
+    if stats is not None:
+        stats.add(pages_parsed=1)
+    return (soup, validators)
+
+
+def create_soup(path, session=None, limiter=None):
+    return fetch_soup(path, session, limiter)[0]
 
 
 def get_author_from_bs_tag(bs_tag):
@@ -74,19 +187,262 @@ def get_post_author_date_and_content(bs_tags):
     return {name: value for name, value in results.items() if value}
 
 
-def collect_beautifulsoup_tags(path):
+def find_beautifulsoup_tags(soup):
     bs_tags = {}
     div_attributes = {
         "author": {"class": "field--name-field-from"},
         "content": {"property": "schema:text"},
         "date": {"class": "node__meta"},
     }
-    soup = create_soup(path)
     for post_property, attrs in div_attributes.items():
         bs_tags[post_property] = soup.find("div", attrs=attrs)
     return bs_tags
 
 
+def collect_beautifulsoup_tags(path, session=None, limiter=None):
+    return find_beautifulsoup_tags(create_soup(path, session, limiter))
+
+
+def fingerprint_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def find_announcement_elements(html):
+    # One pass over the page's divs for the same three elements that
+    # collect_beautifulsoup_tags() looks up with separate soup.find() walks
+    elements = {}
+    for div in lxml_html.fromstring(html).iter("div"):
+        classes = div.get("class", "").split()
+        if "author" not in elements and "field--name-field-from" in classes:
+            elements["author"] = div
+        elif "content" not in elements and div.get("property") == "schema:text":
+            elements["content"] = div
+        elif "date" not in elements and "node__meta" in classes:
+            elements["date"] = div
+        if len(elements) == 3:
+            break
+    return elements
+
+
+def get_author_from_element(element):
+    for div in element.iterdescendants("div"):
+        if "field__item" in div.get("class", "").split():
+            return div.text
+
+
+def get_date_from_element(element):
+    date_pattern = "[A-Za-z]+ [0-9]+, [0-9]+"
+    span_content = next(element.iterdescendants("span")).text
+    return re.search(date_pattern, span_content).group()
+
+
+# Markdown conversion straight from the lxml tree, following html2text's
+# output conventions (78 column paragraphs, "  * " list items, "**" bold,
+# inline links) so messages look the same as before
+WRAP_WIDTH = 78
+LINE_BREAK = "\x00"
+HEADINGS = {f"h{n}": "#" * n for n in range(1, 7)}
+BLOCKS = {"p", "div", "section", "article"}
+INLINE = {"span", "strong", "b", "em", "i", "code", "a", "br"}
+# Content with any other tag (tables, images, rules, blockquotes...) goes
+# through html2text itself rather than losing what we don't convert
+CONVERTED = BLOCKS | INLINE | set(HEADINGS) | {"ul", "ol", "li"}
+
+
+def inline_markdown(element):
+    parts = [element.text or ""]
+    for child in element:
+        parts.append(inline_element_markdown(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def inline_element_markdown(element):
+    tag = element.tag
+    if not isinstance(tag, str):
+        # Comments and processing instructions
+        return ""
+    if tag == "br":
+        return LINE_BREAK
+    text = inline_markdown(element)
+    if not text.strip():
+        return text
+    if tag in ("strong", "b"):
+        return f"**{text}**"
+    if tag in ("em", "i"):
+        return f"_{text}_"
+    if tag == "code":
+        return f"`{text}`"
+    if tag == "a" and element.get("href"):
+        return f"[{text}]({element.get('href')})"
+    return text
+
+
+def wrap_paragraph(text):
+    lines = []
+    for line in text.split(LINE_BREAK):
+        line = " ".join(line.split())
+        lines.append(
+            textwrap.fill(
+                line,
+                width=WRAP_WIDTH,
+                break_long_words=False,
+                break_on_hyphens=False,
+            )
+        )
+    return "  \n".join(lines).strip()
+
+
+def list_markdown(element, indent=0):
+    items = []
+    number = 1
+    for child in element:
+        if child.tag != "li":
+            continue
+        marker = f"{number}. " if element.tag == "ol" else "* "
+        number += 1
+        parts = [child.text or ""]
+        nested = []
+        for grandchild in child:
+            if grandchild.tag in ("ul", "ol"):
+                nested.append(grandchild)
+            else:
+                parts.append(inline_element_markdown(grandchild))
+            parts.append(grandchild.tail or "")
+        text = " ".join("".join(parts).replace(LINE_BREAK, " ").split())
+        items.append(" " * (indent + 2) + marker + text)
+        # Nested lists line up under the parent item's text
+        items.extend(
+            list_markdown(grandchild, indent + len(marker)) for grandchild in nested
+        )
+    return "\n".join(items)
+
+
+def block_markdown(element, blocks):
+    pending = [element.text or ""]
+
+    def flush():
+        text = wrap_paragraph("".join(pending))
+        if text:
+            blocks.append(text)
+        pending.clear()
+
+    for child in element:
+        tag = child.tag
+        if tag in HEADINGS:
+            flush()
+            blocks.append(f"{HEADINGS[tag]} {' '.join(inline_markdown(child).split())}")
+        elif tag in ("ul", "ol"):
+            flush()
+            blocks.append(list_markdown(child))
+        elif tag in BLOCKS:
+            flush()
+            block_markdown(child, blocks)
+        else:
+            pending.append(inline_element_markdown(child))
+        pending.append(child.tail or "")
+    flush()
+    return blocks
+
+
+def element_to_markdown(element):
+    for descendant in element.iterdescendants():
+        if isinstance(descendant.tag, str) and descendant.tag not in CONVERTED:
+            metrics.count("markdown_fallbacks")
+            html = lxml_html.tostring(element, encoding="unicode", with_tail=False)
+            return html2text.html2text(html)
+    blocks = [block for block in block_markdown(element, []) if block.strip()]
+    return "\n\n".join(blocks) + "\n\n"
+
+
+def extract_announcement(html):
+    """
+    Faster get_post_author_date_and_content(collect_beautifulsoup_tags(...))
+    over already fetched html: a single lxml parse and pass, with the content
+    converted to Markdown from the tree instead of re-parsing it with html2text.
+    """
+
+    return extract_announcement_data(find_announcement_elements(html))
+
+
+def extract_announcement_data(elements):
+    property_getters = {
+        "author": get_author_from_element,
+        "date": get_date_from_element,
+        "content": element_to_markdown,
+    }
+    results = {}
+    for property_, property_getter in property_getters.items():
+        try:
+            results[property_] = property_getter(elements.get(property_))
+        except Exception:
+            results[property_] = None
+    return {name: value for name, value in results.items() if value}
+
+
+def crawl_announcements(paths, max_workers=MAX_WORKERS, session=None, limiter=None):
+    # Fetches and parses announcement pages concurrently, results in `paths` order
+    session = webhooks.create_session(max_workers) if session is None else session
+    limiter = HostRateLimiter() if limiter is None else limiter
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(
+            pool.map(
+                lambda path: collect_beautifulsoup_tags(path, session, limiter), paths
+            )
+        )
+
+
+def crawl_updates(
+    paths, cache, stats=None, max_workers=MAX_WORKERS, session=None, limiter=None
+):
+    """
+    Incremental crawl_announcements(): pages we've fetched before are requested
+    conditionally and compared by content fingerprint. Returns a PageResult per
+    path (in order); announcement_data is None for unchanged pages and ones
+    that failed to fetch (error set), edited is True for changed pages that
+    were already seen. New validators/fingerprints are staged
+    in the cache and land with the next mark_seen().
+    """
+
+    session = webhooks.create_session(max_workers) if session is None else session
+    limiter = HostRateLimiter() if limiter is None else limiter
+    # sqlite connections stay on this thread, so look everything up front
+    pages = {path: cache.page(construct_url(path)) for path in paths}
+    seen = cache.seen(paths)
+
+    def crawl(path):
+        try:
+            html, validators = fetch_page(path, session, limiter, pages[path], stats)
+        except requests.RequestException as e:
+            # Skipped (not marked seen) this run, the rest carry on
+            print(f"Fetching {path} failed: {e}")
+            metrics.count("crawl_failures")
+            return PageResult(path, None, False, e)
+        if html is None:
+            return PageResult(path, None, False, None)
+        with metrics.span("parse"):
+            elements = find_announcement_elements(html)
+            content = elements.get("content")
+            digest = fingerprint_text("" if content is None else content.text_content())
+        if stats is not None:
+            stats.add(pages_parsed=1)
+        cache.stage_page(construct_url(path), *validators, digest)
+        if path not in seen:
+            with metrics.span("extract"):
+                return PageResult(
+                    path, extract_announcement_data(elements), False, None
+                )
+        previous = pages[path]
+        # No fingerprint yet just means we're recording a baseline
+        if previous is None or previous[2] == digest:
+            return PageResult(path, None, False, None)
+        with metrics.span("extract"):
+            return PageResult(path, extract_announcement_data(elements), True, None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(crawl, paths))
+
+
 def trim_message_len(message, link):
     if len(message) > MAX_MESSAGE_LEN:
         suffix = f"...\n\n\t(...)\n\nto read full post, go to {link}!"
@@ -115,15 +471,137 @@ def parse_discord_message(announcement_data, path):
     return trim_message_len(msg, link)
 
 
-if __name__ == "__main__":
-
-    all_paths = collect_communications_paths()
-    new_paths = filter_paths(all_paths)
+def split_markdown(text, limit):
+    """
+    Splits text into chunks of at most limit characters. Breaks go between
+    paragraphs where possible, then between lines (list items, headings),
+    then between words, so the Markdown in each chunk still renders.
+    """
+
+    chunks = []
+    while len(text) > limit:
+        window = text[: limit + 1]
+        for separator in ["\n\n", "\n", " "]:
+            cut = window.rfind(separator)
+            # A break near the start would just leave a tiny chunk
+            if cut >= limit // 2:
+                break
+        else:
+            separator, cut = "", limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut + len(separator) :].lstrip("\n")
+    chunks.append(text)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def announcement_embeds(announcement_data, path, edited=False):
+    # The whole announcement as one or more embeds, split rather than truncated
+    link = construct_url(path)
+    text = parse_header(announcement_data, link) + announcement_data.get("content", "")
+    if edited:
+        text = f"(edited)\n{text}"
+    parts = split_markdown(text, PART_LEN)
+    embeds = [{"description": part} for part in parts]
+    if len(parts) > 1:
+        for i, embed in enumerate(embeds):
+            embed["footer"] = {"text": f"Part {i + 1} of {len(parts)}"}
+    return embeds
+
+
+def post_announcements(announcements, urls=None, session=None):
+    """
+    Posts (path, announcement_data, edited) tuples, in order, to every webhook,
+    packing as many embeds into each message as Discord allows. Returns the
+    paths that reached every webhook; the rest should be retried next run.
+    Without webhooks the announcements are only printed, and none are returned.
+    """
+
+    if not announcements:
+        return set()
+    urls = WEBHOOKS if urls is None else urls
+    owners = []
+    embeds = []
+    for path, announcement_data, edited in announcements:
+        parts = announcement_embeds(announcement_data, path, edited)
+        owners += [path] * len(parts)
+        embeds += parts
+    if not urls:
+        # Nothing reached Discord, so nothing counts as posted
+        for embed in embeds:
+            print(embed["description"])
+        return set()
+
+    batches = webhooks.batch_embeds(embeds)
+    # Index of the last message carrying part of each announcement
+    last_message = {}
+    position = 0
+    for index, batch in enumerate(batches):
+        for path in owners[position : position + len(batch)]:
+            last_message[path] = index
+        position += len(batch)
+
+    results = webhooks.deliver_in_order(
+        urls, [{"embeds": batch} for batch in batches], session
+    )
+    for url_results in results.values():
+        webhooks.print_results(url_results[-1:])
+    # deliver_in_order() stops at a webhook's first failure
+    delivered = min(
+        len([result for result in url_results if result.error is None])
+        for url_results in results.values()
+    )
+    metrics.count("announcement_messages", len(batches))
+    return {path for path, index in last_message.items() if index < delivered}
+
+
+def main():
+    cache = AnnouncementCache()
+    stats = CrawlStats()
+    session = webhooks.create_session(MAX_WORKERS)
+    limiter = HostRateLimiter()
+    # New links plus the most recent already-seen ones, to catch edits
+    with metrics.span("listing"):
+        listed_paths = collect_communications_paths(session, limiter, cache, stats)
+        new_paths = filter_paths(listed_paths, cache)
+
+    with metrics.span("crawl"):
+        results = crawl_updates(
+            listed_paths, cache, stats, session=session, limiter=limiter
+        )
+    # The listing is newest first, post oldest first
+    announcements = [
+        (result.path, result.announcement_data, result.edited)
+        for result in reversed(results)
+        if result.announcement_data is not None
+    ]
+    unfetched = [result.path for result in results if result.error is not None]
+    if unfetched:
+        print(f"Failed to fetch {len(unfetched)} announcement(s), retrying next run")
+    with metrics.span("post"):
+        delivered = post_announcements(announcements)
+    failed = [path for path, _, _ in announcements if path not in delivered]
+    if failed and WEBHOOKS:
+        print(f"Failed to post {len(failed)} announcement(s), retrying next run")
+    failed += unfetched
+    if failed:
+        # Forget their (and the listing's) new validators too, or the next run
+        # would get a 304 and never see them again
+        paths = ["/communications"] + failed
+        cache.unstage(construct_url(path) for path in paths)
+
+    # Only announcements that were fetched and posted everywhere are marked
+    # seen, oldest first so that cache.recent() gives the newest back
+    with metrics.span("save"):
+        update_cache(
+            [path for path in reversed(new_paths) if path not in failed], cache
+        )
+    print(f"Crawl: {stats}")
 
-    for path in new_paths:
-        bs_tags = collect_beautifulsoup_tags(path)
-        announcement_data = get_post_author_date_and_content(bs_tags)
-        msg = parse_discord_message(announcement_data, path)
-        print(msg)
 
-    # update_cache(new_paths)
+if __name__ == "__main__":
+    # --profile writes a cProfile dump next to the run report
+    if "--profile" in sys.argv:
+        metrics.profiled(main, REPORT_PATH)
+    else:
+        main()
+    metrics.RUN.write(REPORT_PATH)
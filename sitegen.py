@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# Usage: ./sitegen.py [output directory] [--full]
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+from datetime import date, timedelta
+from html import escape
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from main import DASHBOARD, GRAPH_CACHE, load_previous
+from state import atomic_write
+from timeseries import FIELD_NAMES
+
+SITE_DIR = "public"
+MANIFEST = ".manifest.json"
+# Bump when the page layout or JSON format changes to force a full rebuild
+SITE_VERSION = 1
+RECENT_DAYS = 60
+# Days before an artifact's range that its rolling sums still depend on
+LOOKBACK = 14
+COMPRESSED = (".html", ".json", ".svg")
+# Slow, but only changed artifacts are ever recompressed
+BROTLI_QUALITY = 11
+
+COLUMNS = [
+    "Date",
+    "New positives",
+    "Positives (7 days)",
+    "Positives (14 days)",
+    "Weekly positivity",
+    "Total positives",
+    "Total tests",
+]
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 60em; margin: auto; padding: 1em; }}
+table {{ border-collapse: collapse; width: 100%; }}
+th, td {{ border-bottom: 1px solid #ddd; padding: 0.25em 0.5em; text-align: right; }}
+th:first-child, td:first-child {{ text-align: left; }}
+img {{ max-width: 100%; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+<p>Data from the <a href="{dashboard}">RPI Covid Dashboard</a>.</p>
+</body>
+</html>
+"""
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST), "r") as file:
+            return json.load(file)
+    except:
+        return {}
+
+
+def save_manifest(out_dir, manifest):
+    atomic_write(os.path.join(out_dir, MANIFEST), json.dumps(manifest, sort_keys=True))
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write(path, content)
+
+
+def write_artifact(out_dir, name, content):
+    # Writes name plus .gz/.br siblings that a web server can hand out as-is
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    path = os.path.join(out_dir, name)
+    write_file(path, content)
+    if name.endswith(COMPRESSED):
+        write_file(f"{path}.gz", gzip.compress(content, 9, mtime=0))
+        if brotli is not None:
+            write_file(f"{path}.br", brotli.compress(content, quality=BROTLI_QUALITY))
+
+
+def input_hash(*parts):
+    return hashlib.sha256(repr((SITE_VERSION,) + parts).encode("utf-8")).hexdigest()
+
+
+def percent(value):
+    return "" if value is None else f"{value:.2f}%"
+
+
+def day_rows(covid_data, start, end):
+    # One (date, case_data, DayStats) per recorded day in start..end, newest first
+    analytics = covid_data.analytics
+    rows = [
+        (day, case_data, analytics.at(day))
+        for day, case_data in covid_data.store.range(start, end)
+    ]
+    return rows[::-1]
+
+
+def history_table(rows):
+    header = "".join(f"<th>{escape(name)}</th>" for name in COLUMNS)
+    body = [
+        "<tr>"
+        + "".join(
+            f"<td>{value}</td>"
+            for value in [
+                day.isoformat(),
+                f"{case_data[0]:,}",
+                f"{stats.rolling7:,}",
+                f"{stats.rolling14:,}",
+                percent(stats.positivity),
+                f"{case_data[2]:,}",
+                f"{case_data[4]:,}",
+            ]
+        )
+        + "</tr>"
+        for day, case_data, stats in rows
+    ]
+    return f"<table>\n<tr>{header}</tr>\n" + "\n".join(body) + "\n</table>"
+
+
+def rows_json(rows):
+    return [
+        dict(
+            zip(FIELD_NAMES, case_data),
+            date=day.isoformat(),
+            positives_7_days=stats.rolling7,
+            positives_14_days=stats.rolling14,
+            positivity=stats.positivity,
+        )
+        for day, case_data, stats in rows
+    ]
+
+
+def page(title, body):
+    return PAGE.format(title=escape(title), body=body, dashboard=escape(DASHBOARD))
+
+
+def latest_json(covid_data, years):
+    last, case_data = covid_data.store.last()
+    analytics = covid_data.analytics
+    stats = analytics.at(last)
+    return json.dumps(
+        {
+            "date": last.isoformat(),
+            "case_data": dict(zip(FIELD_NAMES, case_data)),
+            "positives_7_days": stats.rolling7,
+            "positives_14_days": stats.rolling14,
+            "positivity": stats.positivity,
+            "week_over_week": stats.growth,
+            "alerts": [
+                {"trigger": trigger.name, "above": above}
+                for trigger, above in analytics.alerts(last)
+            ],
+            "years": [f"history/{year}.json" for year in years],
+        },
+        indent=1,
+    )
+
+
+def index_html(covid_data, years):
+    last, case_data = covid_data.store.last()
+    stats = covid_data.analytics.at(last)
+    current = (
+        f"<p>As of {last.isoformat()}: <b>{case_data[0]:,}</b> new positive tests, "
+        f"{stats.rolling14:,} in the last 14 days"
+        + (
+            f", {percent(stats.positivity)} weekly positivity"
+            if stats.positivity is not None
+            else ""
+        )
+        + ".</p>"
+    )
+    graph = '<p><img src="graph.svg" alt="Positive tests over the last two weeks"></p>'
+    rows = day_rows(covid_data, last - timedelta(days=RECENT_DAYS - 1), last)
+    links = " ".join(
+        f'<a href="history/{year}.html">{year}</a>' for year in reversed(years)
+    )
+    body = (
+        f"{current}\n{graph}\n<h2>Last {RECENT_DAYS} days</h2>\n{history_table(rows)}\n"
+        f'<p>Full history: {links} &middot; <a href="latest.json">JSON</a></p>'
+    )
+    return page("RPI Covid Dashboard history", body)
+
+
+def build_site(covid_data=None, out_dir=SITE_DIR, full=False, today=None):
+    """
+    Writes the site into out_dir: index.html (current stats, graph and recent
+    history), latest.json, a page and JSON file per year of history, and the
+    graph as PNG and SVG. Each artifact's inputs are hashed and compared with
+    the manifest from the last build; only changed artifacts are rebuilt,
+    unless full is set. Returns (built, skipped) artifact names.
+    """
+
+    from renderer import cache_key, get_renderer, graph_inputs
+
+    covid_data = load_previous() if covid_data is None else covid_data
+    store = covid_data.store
+    if len(store) == 0:
+        raise ValueError("No history to build a site from")
+    today = date.today() if today is None else today
+    first, last = store.first()[0], store.last()[0]
+    years = list(range(first.year, last.year + 1))
+    manifest = {} if full else load_manifest(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    recent = store.digest(last - timedelta(days=RECENT_DAYS + LOOKBACK), last)
+    latest = store.digest(last - timedelta(days=LOOKBACK + 7), last)
+    inputs = graph_inputs(covid_data, today)
+    artifacts = {
+        "index.html": (
+            input_hash(recent, years),
+            lambda: index_html(covid_data, years),
+        ),
+        "latest.json": (
+            input_hash(latest, years),
+            lambda: latest_json(covid_data, years),
+        ),
+        "graph.png": (
+            input_hash(cache_key(inputs)),
+            lambda: get_renderer(GRAPH_CACHE).render(inputs),
+        ),
+        "graph.svg": (
+            input_hash(cache_key(inputs)),
+            lambda: get_renderer().draw(inputs, "svg"),
+        ),
+    }
+    for year in years:
+        start, end = date(year, 1, 1), date(year, 12, 31)
+        digest = input_hash(store.digest(start - timedelta(days=LOOKBACK), end))
+        rows = lambda start=start, end=end: day_rows(covid_data, start, end)
+        artifacts[f"history/{year}.html"] = (
+            digest,
+            lambda year=year, rows=rows: page(
+                f"RPI Covid Dashboard history, {year}", history_table(rows())
+            ),
+        )
+        artifacts[f"history/{year}.json"] = (
+            digest,
+            lambda rows=rows: json.dumps(rows_json(rows())),
+        )
+
+    built, skipped = [], []
+    for name, (digest, build) in artifacts.items():
+        if manifest.get(name) == digest and os.path.exists(os.path.join(out_dir, name)):
+            skipped.append(name)
+            continue
+        write_artifact(out_dir, name, build())
+        manifest[name] = digest
+        built.append(name)
+    save_manifest(out_dir, manifest)
+    return (built, skipped)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    built, skipped = build_site(
+        out_dir=args[0] if args else SITE_DIR, full="--full" in sys.argv
+    )
+    print(f"Built {len(built)} artifacts, {len(skipped)} unchanged")
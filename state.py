@@ -0,0 +1,191 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import struct
+import time
+import weakref
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks (Windows), so overlapping runs aren't serialized there
+    fcntl = None
+
+# Seconds to wait for another run to finish with the state before giving up
+LOCK_TIMEOUT = 600
+
+
+def fsync_directory(path):
+    # Makes a rename or removal in path durable; not possible everywhere
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, content):
+    # Readers (and a run after a crash) see the old content or the new, never a mix
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    temp = f"{path}.tmp"
+    with open(temp, "wb") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+    fsync_directory(os.path.dirname(path))
+
+
+# Locks this process holds. A forked child (the graph worker, say) shares
+# their open files, which would keep them locked after we release them
+_held = weakref.WeakSet()
+
+
+def _close_inherited_locks():
+    # In the child: closing our copy of the file leaves the parent's lock be
+    for lock in list(_held):
+        if lock._file is not None:
+            lock._file.close()
+            lock._file = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_close_inherited_locks)
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on path (a file of its own, so the state it
+    guards can be replaced by renames while it's held). Closing the file,
+    or the process dying, releases it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, timeout=LOCK_TIMEOUT, interval=0.05):
+        self._file = open(self.path, "a")
+        _held.add(self)
+        if fcntl is None:
+            return
+        deadline = time.monotonic() + timeout
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self.release()
+                    raise TimeoutError(f"{self.path} is still held by another run")
+                if not waiting:
+                    print(f"Waiting for another run to release {self.path}")
+                    waiting = True
+                time.sleep(interval)
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Journal:
+    """
+    Undo log for the writes to one file since it was last committed. log()
+    makes each entry (where the write goes, how long it is and the bytes it
+    overwrites) durable before the write itself is made. commit() makes the
+    writes permanent by dropping the log; a log still there when the file is
+    next opened means the run died before committing, and rollback() undoes
+    every logged write, torn ones included. An entry torn by the crash fails
+    its checksum; its write never started and it's dropped.
+    """
+
+    ENTRY = struct.Struct("<QII")
+    CHECKSUM = struct.Struct("<I")
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def log(self, offset, length, old):
+        # old is what the write of length bytes at offset replaces; shorter
+        # than length where the write extends the file
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        entry = self.ENTRY.pack(offset, length, len(old)) + old
+        self._file.write(entry + self.CHECKSUM.pack(zlib.crc32(entry)))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def entries(self):
+        # Every complete entry, in order, as (offset, length, old)
+        try:
+            with open(self.path, "rb") as file:
+                log = file.read()
+        except FileNotFoundError:
+            return []
+        entries = []
+        position = 0
+        while position + self.ENTRY.size <= len(log):
+            offset, length, size = self.ENTRY.unpack_from(log, position)
+            end = position + self.ENTRY.size + size
+            if end + self.CHECKSUM.size > len(log):
+                break
+            (checksum,) = self.CHECKSUM.unpack_from(log, end)
+            if checksum != zlib.crc32(log[position:end]):
+                break
+            entries.append((offset, length, log[position + self.ENTRY.size : end]))
+            position = end + self.CHECKSUM.size
+        return entries
+
+    def rollback(self, file):
+        # Undoes the uncommitted writes on file (opened r+b), newest first;
+        # returns how many there were
+        entries = self.entries()
+        for offset, length, old in reversed(entries):
+            file.seek(offset)
+            file.write(old)
+            if len(old) < length:
+                # The write extended the file, so it ended at offset + len(old)
+                file.truncate(offset + len(old))
+        if entries:
+            file.flush()
+            os.fsync(file.fileno())
+        # The file is back at its last committed state
+        self.commit()
+        return len(entries)
+
+    def commit(self):
+        # Only once the writes it covers are durable
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            fsync_directory(os.path.dirname(self.path))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
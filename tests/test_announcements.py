@@ -0,0 +1,175 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+from urllib.parse import urlsplit
+
+import pytest
+from bs4 import BeautifulSoup
+
+import rpi_scraper
+import webhooks
+from announcement_cache import AnnouncementCache
+from benchmark import FIXTURES, quietly, read_fixture, serve_discord, serve_fixtures
+
+SLUGS = sorted(
+    name[: -len(".html")]
+    for name in os.listdir(os.path.join(FIXTURES, "site", "announcements"))
+)
+
+
+def announcement_html(slug):
+    return read_fixture(os.path.join("site", "announcements", f"{slug}.html")).decode()
+
+
+def extract_with_beautifulsoup(html):
+    soup = BeautifulSoup(html, features="lxml")
+    bs_tags = rpi_scraper.find_beautifulsoup_tags(soup)
+    return rpi_scraper.get_post_author_date_and_content(bs_tags)
+
+
+@pytest.mark.parametrize(
+    "extract",
+    [extract_with_beautifulsoup, rpi_scraper.extract_announcement],
+    ids=["beautifulsoup", "lxml"],
+)
+@pytest.mark.parametrize("slug", SLUGS)
+def test_extract_matches_golden(slug, extract):
+    # Goldens were recorded from the BeautifulSoup + html2text path: the header
+    # and the whole content, as post_announcements() sends them
+    data = extract(announcement_html(slug))
+    link = rpi_scraper.construct_url(f"/announcements/{slug}")
+    golden = read_fixture(os.path.join("golden", f"{slug}.txt")).decode()
+    assert rpi_scraper.parse_header(data, link) + data["content"] == golden
+
+
+@pytest.mark.parametrize("slug", [s for s in SLUGS if s != "spring-testing-sites"])
+def test_plain_announcements_skip_html2text(slug, monkeypatch):
+    # Only content with tags the lxml converter doesn't handle (like
+    # spring-testing-sites' table, image, rule and blockquote) falls back
+    def html2text(html):
+        raise AssertionError("fell back to html2text")
+
+    monkeypatch.setattr(rpi_scraper.html2text, "html2text", html2text)
+    rpi_scraper.extract_announcement(announcement_html(slug))
+
+
+def long_announcements(count=30):
+    # Long enough to be split over two or three embeds each
+    extracted = [rpi_scraper.extract_announcement(announcement_html(s)) for s in SLUGS]
+    announcements = []
+    for i in range(count):
+        data = dict(extracted[i % len(extracted)])
+        data["content"] = "\n\n".join(
+            [data["content"]] * (7000 // len(data["content"]) + 1)
+        )
+        announcements.append((f"/announcements/long-{i}", data, i % 4 == 0))
+    return announcements
+
+
+@pytest.fixture
+def discord():
+    # Two webhooks on a stand-in taking 5 posts per 0.1s each
+    server, webhook = serve_discord(limit=5, window=0.1)
+    session = webhooks.create_session()
+    yield server, [webhook, webhook.replace("/1/", "/2/")], session
+    session.close()
+    server.shutdown()
+
+
+def embeds_posted(server, url):
+    return [
+        embed
+        for webhook, payload in server.posts
+        if webhook == urlsplit(url).path
+        for embed in payload["embeds"]
+    ]
+
+
+def test_posting_is_paced_by_the_rate_limit(discord):
+    server, urls, session = discord
+    announcements = long_announcements()
+    delivered = quietly(rpi_scraper.post_announcements, announcements, urls, session)
+    assert delivered == {path for path, _, _ in announcements}
+    # Everything arrived, in order, without a single 429
+    assert server.limited == 0
+    everything = [
+        embed
+        for path, data, edited in announcements
+        for embed in rpi_scraper.announcement_embeds(data, path, edited)
+    ]
+    assert all(embeds_posted(server, url) == everything for url in urls)
+
+
+def test_only_announcements_on_every_webhook_count_as_posted(discord):
+    server, urls, session = discord
+    announcements = long_announcements()
+    # The second webhook fails part way
+    server.fail_after[urlsplit(urls[1]).path] = 7
+    delivered = quietly(rpi_scraper.post_announcements, announcements, urls, session)
+    complete = {
+        path
+        for path, data, edited in announcements
+        if all(
+            embed in embeds_posted(server, url)
+            for url in urls
+            for embed in rpi_scraper.announcement_embeds(data, path, edited)
+        )
+    }
+    assert delivered == complete
+    assert 0 < len(complete) < len(announcements)
+
+
+def test_a_single_webhook_url_works_like_a_list(discord):
+    # config.webhooks may be a plain string
+    server, urls, session = discord
+    announcements = long_announcements(3)
+    delivered = quietly(rpi_scraper.post_announcements, announcements, urls[0], session)
+    assert delivered == {path for path, _, _ in announcements}
+    assert {webhook for webhook, payload in server.posts} == {urlsplit(urls[0]).path}
+
+
+def test_nothing_counts_as_posted_without_webhooks():
+    announcements = long_announcements(3)
+    assert quietly(rpi_scraper.post_announcements, announcements, []) == set()
+
+
+def test_concurrent_crawl_matches_sequential():
+    server, base = serve_fixtures(directory=os.path.join(FIXTURES, "site"))
+    home_url, rpi_scraper.HOME_URL = rpi_scraper.HOME_URL, base
+    try:
+        paths = [f"/announcements/{slug}" for slug in SLUGS]
+        sequential = [rpi_scraper.collect_beautifulsoup_tags(path) for path in paths]
+        limiter = webhooks.HostRateLimiter(0)
+        crawled = rpi_scraper.crawl_announcements(paths, 8, limiter=limiter)
+        assert [str(r) for r in crawled] == [str(r) for r in sequential]
+    finally:
+        rpi_scraper.HOME_URL = home_url
+        server.shutdown()
+
+
+def test_filter_new_keeps_listing_order(tmp_path):
+    lines = tmp_path / "lines"
+    lines.write_text("".join(f"/announcements/old-{i}\n" for i in range(100)))
+    cache = AnnouncementCache(str(tmp_path / "db"), str(lines))
+    try:
+        listed = [
+            "/announcements/new-1",
+            "/announcements/old-5",
+            "/announcements/new-0",
+        ]
+        assert cache.filter_new(listed) == [
+            "/announcements/new-1",
+            "/announcements/new-0",
+        ]
+        cache.mark_seen(["/announcements/new-1"])
+        assert cache.filter_new(listed) == ["/announcements/new-0"]
+    finally:
+        cache.close()
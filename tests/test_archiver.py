@@ -0,0 +1,94 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+
+import pytest
+
+import archiver
+import main
+from benchmark import quietly, serve_discord
+
+
+class Archive:
+    # Stand-in for savepagenow.capture(): records every capture, and fails the
+    # urls in failing
+    def __init__(self):
+        self.captured = []
+        self.failing = set()
+
+    def capture(self, url):
+        self.captured.append(url)
+        if url in self.failing:
+            raise ConnectionError(f"Capturing {url} failed")
+        return self.archived(url)
+
+    @staticmethod
+    def archived(url):
+        return f"https://web.archive.org/web/20210101000000/{url}"
+
+
+@pytest.fixture
+def discord():
+    server, webhook = serve_discord()
+    yield server, webhook
+    server.shutdown()
+
+
+def test_same_content_is_captured_once_and_every_post_linked(tmp_path, discord):
+    server, webhook = discord
+    archive = Archive()
+    path = str(tmp_path / "archive")
+    queue = archiver.ArchiveQueue(path)
+    queue.enqueue("https://a/dashboard", "a", [(webhook, "11", "first")])
+    queue.enqueue("https://a/dashboard", "a", [(webhook, "12", "second")])
+    # Queued jobs carry over to the next run
+    queue = archiver.ArchiveQueue(path)
+    assert [content_hash for content_hash, job in queue.pending()] == ["a"]
+
+    def run():
+        archiver.start_background(queue, archive.capture, main.link_archive)
+        archiver.wait_for_background(30)
+
+    quietly(run)
+    archived = archive.archived("https://a/dashboard")
+    assert archive.captured == ["https://a/dashboard"]
+    assert sorted(server.edits) == [
+        ("11", {"content": f"first\nArchived dashboard: {archived}"}),
+        ("12", {"content": f"second\nArchived dashboard: {archived}"}),
+    ]
+    # So do finished captures
+    queue = archiver.ArchiveQueue(path)
+    assert queue.archived_url("a") == archived
+    assert queue.pending() == []
+
+
+def test_failing_capture_stops_at_max_attempts(tmp_path):
+    archive = Archive()
+    archive.failing.add("https://b/dashboard")
+    path = str(tmp_path / "archive")
+    archiver.ArchiveQueue(path).enqueue("https://b/dashboard", "b")
+    # retries + 1 tries per run, MAX_ATTEMPTS over all runs
+    tries = []
+    for _ in range(3):
+        del archive.captured[:]
+        queue = archiver.ArchiveQueue(path)
+        quietly(queue.run_pending, archive.capture, retries=2, backoff=0)
+        tries.append(len(archive.captured))
+    assert tries == [3, archiver.MAX_ATTEMPTS - 3, 0]
+    assert queue.jobs["b"]["attempts"] == archiver.MAX_ATTEMPTS
+    assert queue.pending() == []
+
+
+def test_hung_capture_counts_as_a_failed_attempt(tmp_path):
+    queue = archiver.ArchiveQueue(str(tmp_path / "archive"))
+    queue.enqueue("https://c/dashboard", "c")
+    quietly(queue.run_pending, lambda url: time.sleep(1), timeout=0.05, retries=0)
+    assert queue.jobs["c"]["attempts"] == 1
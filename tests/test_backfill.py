@@ -0,0 +1,104 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import re
+from datetime import date, timedelta
+
+import pytest
+
+import backfill
+import main
+from benchmark import quietly, read_fixture, serve_wayback
+from webhooks import HostRateLimiter
+
+DAYS = 120
+FIRST_DAY = date(2020, 8, 1)
+# Days we recorded ourselves, which the backfill has to leave alone
+OURS = {FIRST_DAY + timedelta(days=i): [999, 0, 0, 0, 0] for i in range(0, DAYS, 10)}
+# Days the archive fails to serve either capture of at first
+LOST = {FIRST_DAY + timedelta(days=i) for i in range(5, DAYS, 11)}
+
+
+def archived_days():
+    # Two captures a day, each with its own new positives; the later one wins
+    template = read_fixture("dashboard_daily.html").decode()
+    stat = re.compile(r"(field--name-field-stat field--type-string[^>]*>)3<")
+    captures, latest, broken = {}, {}, set()
+    for i in range(DAYS):
+        day = FIRST_DAY + timedelta(days=i)
+        for hour, positives in [(9, 100 + i % 50), (17, i % 50)]:
+            timestamp = f"{day:%Y%m%d}{hour:02}0000"
+            html = stat.sub(rf"\g<1>{positives}<", template, count=1)
+            captures[timestamp] = html.encode("utf-8")
+            # Some days' morning capture fails too, the evening one still counts
+            if day in LOST or hour == 9 and i % 7 == 3:
+                broken.add(timestamp)
+        latest[day] = i % 50
+    return captures, latest, broken
+
+
+@pytest.fixture
+def wayback(tmp_path, monkeypatch):
+    # The Wayback Machine stand-in, with the broken captures 404ing
+    captures, latest, broken = archived_days()
+    served = dict(captures)
+    served.update(dict.fromkeys(broken))
+    server, base, log = serve_wayback(served)
+    # The snapshot cache and index.json live under the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backfill, "CDX_PAGE_SIZE", 50)
+    yield base, log, served, captures, latest, broken
+    server.shutdown()
+
+
+def run(base, data):
+    limiter = HostRateLimiter(0)
+    return quietly(backfill.backfill, wayback=base, covid_data=data, limiter=limiter)
+
+
+def snapshots_fetched(log):
+    return len([path for path in log if path.startswith("/web/")])
+
+
+def test_backfill_resumes_and_merges_only_missing_days(wayback):
+    base, log, served, captures, latest, broken = wayback
+    data = main.CovidData()
+    data.replace_history(OURS)
+    missing = LOST - OURS.keys()
+
+    added = run(base, data)
+    # Every page of the listing followed, every capture fetched once
+    assert log.count("/cdx/search/cdx") == -(-len(captures) // 50)
+    assert snapshots_fetched(log) == len(captures)
+    assert added == DAYS - len(OURS) - len(missing)
+
+    # Resuming goes by index.json alone: with the snapshot cache gone, only
+    # the captures that failed are fetched again
+    for name in os.listdir(backfill.BACKFILL_CACHE):
+        if name.endswith(".html"):
+            os.remove(os.path.join(backfill.BACKFILL_CACHE, name))
+    served.update(captures)
+    del log[:]
+    assert run(base, data) == len(missing)
+    assert snapshots_fetched(log) == len(broken)
+
+    # Only missing days were merged, each from its latest capture
+    history = data.historicalData
+    assert all(history[day] == case_data for day, case_data in OURS.items())
+    assert all(
+        history[day][0] == positives
+        for day, positives in latest.items()
+        if day not in OURS
+    )
+
+    del log[:]
+    assert run(base, data) == 0
+    assert snapshots_fetched(log) == 0
@@ -0,0 +1,56 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+
+import pytest
+
+import changes
+from benchmark import read_fixture
+
+TABLE = json.loads(read_fixture("change_cases.json"))
+
+
+def rules(case):
+    return changes.make_rules(case.get("rules", {}))
+
+
+@pytest.mark.parametrize("case", TABLE["cases"], ids=lambda case: case["name"])
+def test_classify(case):
+    snapshots = [[changes.snapshot_hash(s), s] for s in case["snapshots"]]
+    change = changes.classify(case["current"], case["previous"], snapshots, rules(case))
+    assert change.kind == case["kind"]
+    assert list(change.diff) == case["changed"]
+
+
+@pytest.mark.parametrize(
+    "sequence", TABLE["sequences"], ids=lambda sequence: sequence["name"]
+)
+def test_poll_sequence(sequence):
+    # Polls as main.poll() does: only posting moves previous along
+    previous, poll_state, kinds, posted = sequence["previous"], {}, [], 0
+    changes.remember(poll_state, previous, rules(sequence))
+    for current in sequence["polls"]:
+        change = changes.classify(
+            current, previous, poll_state["snapshots"], rules(sequence)
+        )
+        changes.remember(poll_state, current, rules(sequence))
+        kinds.append(change.kind)
+        if change.kind in rules(sequence).post:
+            previous, posted = current, posted + 1
+    assert kinds == sequence["kinds"]
+    assert posted == sequence["posted"]
+
+
+def test_bad_rules_fail_loudly():
+    with pytest.raises(ValueError):
+        changes.make_rules({"posts": ["new"]})
+    with pytest.raises(ValueError):
+        changes.make_rules({"post": ["new", "nonsense"]})
@@ -0,0 +1,161 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import re
+import signal
+from datetime import datetime, timedelta
+
+import pytest
+
+import daemon
+import main
+import metrics
+import webhooks
+from benchmark import quietly, read_fixture, serve_discord, serve_fixtures
+
+NOON = datetime(2021, 1, 5, 12, 0)
+
+
+def test_next_interval_follows_the_publish_window():
+    # Learned from RPI publishing at 17:00 the day before
+    published = ["2021-01-04T17:00"]
+    scheduler = daemon.PollScheduler(60, 1800, 300, window=45)
+    assert scheduler.next_interval(NOON, []) == 300
+    # Just seen an update: back off all the way
+    assert scheduler.next_interval(NOON, published, changed=True) == 1800
+    times = [(15, 50), (16, 30), (16, 59), (17, 50), (18, 0), (18, 5), (18, 15)]
+    times += [(18, 40), (19, 10)]
+    intervals = [
+        scheduler.next_interval(datetime(2021, 1, 5, hour, minute), published)
+        for hour, minute in times
+    ]
+    # Woken up in time for the window (16:15), tight polling inside it, then
+    # backing off exponentially again
+    assert intervals == [1500, 60, 60, 120, 240, 480, 960, 1800, 1800]
+
+
+class Dashboard:
+    # The dashboard page, served locally; publish() puts new numbers up
+    STAT = re.compile(r"(field--name-field-stat field--type-string[^>]*>)3<")
+
+    def __init__(self, directory):
+        self.template = read_fixture("dashboard_daily.html").decode()
+        self.path = os.path.join(directory, "dashboard.html")
+        self.mtime = 1000000000
+        self.publish(3)
+        self.server, base = serve_fixtures(directory=directory)
+        self.url = f"{base}/dashboard.html"
+
+    def publish(self, positives):
+        with open(self.path, "w") as file:
+            file.write(self.STAT.sub(rf"\g<1>{positives}<", self.template, count=1))
+        # Keeps If-Modified-Since honest within the same second
+        self.mtime += 1000
+        os.utime(self.path, (self.mtime, self.mtime))
+
+
+@pytest.fixture
+def daemon_env(tmp_path, monkeypatch):
+    # A run directory, the dashboard and Discord stand-ins, and counts of the
+    # poll_state and run report writes
+    site = tmp_path / "site"
+    site.mkdir()
+    dashboard = Dashboard(str(site))
+    discord, webhook = serve_discord()
+    writes = {"poll_state": 0, "metrics": 0}
+    save_poll_state = daemon.save_poll_state
+
+    def counted_save(*args):
+        writes["poll_state"] += 1
+        save_poll_state(*args)
+
+    def counted_write(*args):
+        writes["metrics"] += 1
+        metrics.Metrics.write(metrics.RUN, *args)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "DASHBOARD", dashboard.url)
+    monkeypatch.setattr(main, "WEBHOOKS", [webhook])
+    monkeypatch.setattr(daemon, "save_poll_state", counted_save)
+    monkeypatch.setattr(metrics.RUN, "write", counted_write, raising=False)
+    handlers = [signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)]
+    yield dashboard, discord, writes
+    signal.signal(signal.SIGTERM, handlers[0])
+    signal.signal(signal.SIGINT, handlers[1])
+    discord.shutdown()
+    dashboard.server.shutdown()
+
+
+def run_daemon(polls, on_wait):
+    # run_daemon() on a fake clock; on_wait(n) runs during the nth wait
+    clock, waits = [NOON], []
+
+    def wait(seconds):
+        waits.append(seconds)
+        clock[0] += timedelta(seconds=seconds)
+        on_wait(len(waits))
+
+    count = quietly(
+        daemon.run_daemon, ci=True, now=lambda: clock[0], wait=wait, max_polls=polls
+    )
+    assert count == polls and len(waits) == polls
+    return waits
+
+
+def test_daemon_persists_only_on_change(daemon_env):
+    dashboard, discord, writes = daemon_env
+    run_daemon(8, lambda waits: waits == 3 and dashboard.publish(7))
+    # Both updates posted, and the disk only touched for them (plus once on
+    # the way out)
+    assert len(discord.posts) == 2
+    assert writes == {"poll_state": 3, "metrics": 3}
+    assert main.load_poll_state()["update_times"] == [
+        "2021-01-05T12:00",
+        "2021-01-05T13:30",
+    ]
+    covid_data = main.load_previous()
+    assert covid_data.get_case_data()[0] == 7
+    covid_data.store.close()
+
+
+def test_reverts_are_not_updates(daemon_env):
+    dashboard, discord, _ = daemon_env
+    covid_data, poll_state = main.load_previous(), {}
+    try:
+        assert quietly(main.poll, covid_data, poll_state, True, now=NOON)
+        dashboard.publish(7)
+        later = NOON + timedelta(hours=1)
+        assert quietly(main.poll, covid_data, poll_state, True, now=later)
+        # Back to the numbers from an hour ago: not posted, and not a publish
+        # time for the scheduler to learn from
+        dashboard.publish(3)
+        later += timedelta(hours=1)
+        assert not quietly(main.poll, covid_data, poll_state, True, now=later)
+    finally:
+        covid_data.store.close()
+    assert len(discord.posts) == 2
+    assert poll_state["update_times"] == ["2021-01-05T12:00", "2021-01-05T13:00"]
+
+
+def test_daemon_posts_through_its_own_session(daemon_env, monkeypatch):
+    dashboard, discord, _ = daemon_env
+    sessions, create_session = [], webhooks.create_session
+
+    def counted_session(*args, **kwargs):
+        sessions.append(create_session(*args, **kwargs))
+        return sessions[-1]
+
+    monkeypatch.setattr(daemon, "create_session", counted_session)
+    monkeypatch.setattr(webhooks, "create_session", counted_session)
+    run_daemon(4, lambda waits: waits == 2 and dashboard.publish(7))
+    # Both posts went out, without a connection pool of their own each
+    assert len(discord.posts) == 2
+    assert len(sessions) == 1
@@ -0,0 +1,145 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from random import Random
+
+from state import atomic_write
+from timeseries import TimeSeriesStore, migrate_pickle
+
+
+def crash_writer(path, seed):
+    # Adds one day at a time until it's killed
+    # Waiting for the lock is the normal case here
+    sys.stdout = open(os.devnull, "w")
+    rng = Random(seed)
+    acks = os.open(f"{path}.acks", os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    while True:
+        store = TimeSeriesStore(path)
+        last = store.last()
+        if last is not None and rng.random() < 0.1:
+            store.replace_all(dict(store.items()))
+        elif last is not None and rng.random() < 0.3:
+            # Re-recording the latest day overwrites it in place
+            store.append(*last)
+        day = date(2000, 1, 1) if last is None else last[0] + timedelta(days=1)
+        store.append(day, [day.toordinal()] * 5)
+        store.flush()
+        # Only acknowledged once it's durable
+        os.write(acks, f"{day.toordinal()}\n".encode())
+        atomic_write(f"{path}.json", json.dumps({"last": day.isoformat()}))
+        store.close()
+
+
+def test_store_survives_writers_killed_at_random(tmp_path, writers=8, seconds=3.0):
+    rng = Random(writers)
+    context = multiprocessing.get_context("fork")
+    path = str(tmp_path / "series")
+    start = lambda i: context.Process(target=crash_writer, args=(path, i), daemon=True)
+    processes = [start(i) for i in range(writers)]
+    kills = 0
+    # Writers only ever stop because we killed them
+    crashed = []
+    try:
+        for process in processes:
+            process.start()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not crashed:
+            time.sleep(rng.uniform(0, 0.02))
+            crashed = [p.exitcode for p in processes if p.exitcode is not None]
+            i = rng.randrange(writers)
+            processes[i].kill()
+            processes[i].join()
+            processes[i] = start(i + kills * writers)
+            processes[i].start()
+            kills += 1
+    finally:
+        for process in processes:
+            process.kill()
+            process.join()
+    assert not crashed, f"writers crashed with exit codes {crashed}"
+
+    with open(f"{path}.acks") as file:
+        acked = {int(line) for line in file if line.strip()}
+    store = TimeSeriesStore(path)
+    records = store.items()
+    store.close()
+    with open(f"{path}.json") as file:
+        json.load(file)
+
+    ordinals = [day.toordinal() for day, _ in records]
+    # One record per day with nothing missing, torn or mixed up between writers
+    assert ordinals == list(range(ordinals[0], ordinals[0] + len(ordinals)))
+    assert all(case_data == [day.toordinal()] * 5 for day, case_data in records)
+    # Nothing that was acknowledged got lost
+    assert acked <= set(ordinals)
+
+
+def test_uncommitted_writes_are_rolled_back(tmp_path):
+    path = str(tmp_path / "series")
+    store = TimeSeriesStore(path)
+    store.append(date(2021, 1, 1), [1] * 5)
+    store.append(date(2021, 1, 2), [2] * 5)
+    store.flush()
+    store.close()
+
+    pid = os.fork()
+    if pid == 0:
+        # Killed after writing (and reading back, which pushes the writes to
+        # the file) but before flush() commits
+        store = TimeSeriesStore(path)
+        store.append(date(2021, 1, 2), [3] * 5)
+        store.append(date(2021, 1, 3), [4] * 5)
+        store.items()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    store = TimeSeriesStore(path)
+    assert store.items() == [(date(2021, 1, 1), [1] * 5), (date(2021, 1, 2), [2] * 5)]
+    store.close()
+    assert not os.path.exists(f"{path}.journal")
+
+
+class CovidData:
+    # Pickled under the old class' name, like the caches migrate_pickle() reads
+    pass
+
+
+def test_migration_leaves_a_store_another_run_has_open(tmp_path):
+    legacy = CovidData()
+    legacy.historicalData = {date(2021, 1, 1): [1] * 5}
+    pickle_path, path = str(tmp_path / "cache"), str(tmp_path / "series")
+    with open(pickle_path, "wb") as file:
+        pickle.dump(legacy, file)
+
+    # Another run has already migrated and is recording a new day
+    other = TimeSeriesStore(path)
+    other.replace_all(legacy.historicalData)
+    migrated = []
+    thread = threading.Thread(
+        target=lambda: migrated.append(migrate_pickle(pickle_path, path))
+    )
+    thread.start()
+    time.sleep(0.3)
+    other.append(date(2021, 1, 2), [2] * 5)
+    other.close()
+    thread.join()
+
+    store = migrated[0]
+    assert store.items() == [(date(2021, 1, 1), [1] * 5), (date(2021, 1, 2), [2] * 5)]
+    store.close()
+    assert sorted(os.listdir(tmp_path)) == ["cache", "series", "series.lock"]
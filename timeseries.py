@@ -0,0 +1,287 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+from datetime import date, timedelta
+
+import state
+
+# On-disk layout:
+#   header: 4 byte magic + uint32 version
+#   records: uint32 date ordinal + 5 int64 case data fields (see
+#            normalize_case_data in main.py), sorted by date, one per day
+MAGIC = b"CVTS"
+VERSION = 1
+HEADER = struct.Struct("<4sI")
+RECORD = struct.Struct("<I5q")
+FIELDS = 5
+FIELD_NAMES = [
+    "new_positives",
+    "weekly_positives",
+    "total_positives",
+    "weekly_tests",
+    "total_tests",
+]
+
+
+class TimeSeriesStore:
+    """
+    Append-only, date-keyed store of fixed-width case data records.
+    Reads go through an mmap so a date range costs a binary search plus the
+    records in that range, regardless of how long the history is.
+    path=None keeps the records in memory (used for fresh/throwaway data).
+
+    A file-backed store is locked (path.lock) from open until close(), so
+    overlapping runs take turns. Record writes are journaled (path.journal)
+    until flush() commits them; if the run dies first, the next open rolls
+    them back. replace_all() swaps in a complete new file. Either way a crash
+    at any point leaves the last committed state.
+    """
+
+    def __init__(self, path=None, lock_timeout=state.LOCK_TIMEOUT):
+        self.path = path
+        self._map = None
+        if path is None:
+            self._file = None
+            self._buffer = bytearray(HEADER.pack(MAGIC, VERSION))
+            return
+
+        self._file = None
+        self._lock = state.FileLock(f"{path}.lock")
+        self._lock.acquire(lock_timeout)
+        self._journal = state.Journal(f"{path}.journal")
+        try:
+            exists = os.path.exists(path) and os.path.getsize(path) > 0
+            self._file = open(path, "r+b" if exists else "w+b")
+            if not exists:
+                self._file.write(HEADER.pack(MAGIC, VERSION))
+            # Undo whatever the last run wrote but never committed
+            self._journal.rollback(self._file)
+            self._file.seek(0)
+            magic, version = HEADER.unpack(self._file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a v{VERSION} time series store")
+            # Drop a torn trailing record the journal didn't cover
+            size = os.path.getsize(path)
+            whole = HEADER.size + (size - HEADER.size) // RECORD.size * RECORD.size
+            if whole != size:
+                self._file.truncate(whole)
+            self._file.flush()
+        except:
+            self.close()
+            raise
+
+    def _view(self):
+        if self._file is None:
+            return self._buffer
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _invalidate(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return (len(self._view()) - HEADER.size) // RECORD.size
+
+    def _read(self, index):
+        record = RECORD.unpack_from(self._view(), HEADER.size + index * RECORD.size)
+        return (date.fromordinal(record[0]), list(record[1:]))
+
+    def _ordinal(self, index):
+        return struct.unpack_from(
+            "<I", self._view(), HEADER.size + index * RECORD.size
+        )[0]
+
+    def _bisect(self, day):
+        # Index of the first record dated on or after day
+        target = day.toordinal()
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self._ordinal(mid) < target:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    @staticmethod
+    def _pack(day, case_data):
+        values = (list(case_data) + [0] * FIELDS)[:FIELDS]
+        return RECORD.pack(day.toordinal(), *values)
+
+    def _write(self, index, day, case_data):
+        record = self._pack(day, case_data)
+        offset = HEADER.size + index * RECORD.size
+        if self._file is None:
+            self._buffer[offset : offset + RECORD.size] = record
+            return
+        self._invalidate()
+        self._file.seek(offset)
+        self._journal.log(offset, len(record), self._file.read(len(record)))
+        self._file.seek(offset)
+        self._file.write(record)
+
+    def append(self, day, case_data):
+        """
+        Stores case_data for day. Re-recording the latest day overwrites it in
+        place; anything older has to go through replace_all().
+        """
+
+        count = len(self)
+        if count > 0:
+            last = self._ordinal(count - 1)
+            if day.toordinal() == last:
+                return self._write(count - 1, day, case_data)
+            if day.toordinal() < last:
+                raise ValueError(f"Cannot append {day}, store already ends later")
+        self._write(count, day, case_data)
+
+    def truncate(self, count):
+        # Drops every record from index count on
+        if count >= len(self):
+            return
+        if self._file is None:
+            del self._buffer[HEADER.size + count * RECORD.size :]
+            return
+        # Commit first, rolling back afterwards could write past the new end
+        self.flush()
+        self._invalidate()
+        self._file.truncate(HEADER.size + count * RECORD.size)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def get(self, day):
+        index = self._bisect(day)
+        if index < len(self) and self._ordinal(index) == day.toordinal():
+            return self._read(index)[1]
+        return None
+
+    def range(self, start, end):
+        # All (date, case_data) records with start <= date <= end
+        index = self._bisect(start)
+        stop = self._bisect(end + timedelta(days=1))
+        return [self._read(i) for i in range(index, stop)]
+
+    def digest(self, start, end):
+        # sha256 over the raw records with start <= date <= end, without decoding them
+        index = self._bisect(start)
+        stop = self._bisect(end + timedelta(days=1))
+        view = self._view()
+        return hashlib.sha256(
+            view[HEADER.size + index * RECORD.size : HEADER.size + stop * RECORD.size]
+        ).hexdigest()
+
+    def first(self):
+        return None if len(self) == 0 else self._read(0)
+
+    def last(self):
+        return None if len(self) == 0 else self._read(len(self) - 1)
+
+    def items(self):
+        return [self._read(i) for i in range(len(self))]
+
+    def replace_all(self, history):
+        # Rewrites the whole store from a {date: case_data} dict
+        if self._file is None:
+            del self._buffer[HEADER.size :]
+            for day in sorted(history):
+                self._write(len(self), day, history[day])
+            return
+        # Journaled writes must be committed first, rolling them back later
+        # would scribble over the new file
+        self.flush()
+        self._invalidate()
+        records = b"".join(self._pack(day, history[day]) for day in sorted(history))
+        state.atomic_write(self.path, HEADER.pack(MAGIC, VERSION) + records)
+        self._file.close()
+        self._file = open(self.path, "r+b")
+
+    def flush(self):
+        # Commits every write so far
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._journal.commit()
+
+    def close(self):
+        self._invalidate()
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            self._journal.close()
+            self._lock.release()
+
+
+class LegacyCovidData:
+    # Stand-in for pickled main.CovidData objects so migration never runs
+    # the current class' __init__/properties against old attributes
+    pass
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == "CovidData":
+            return LegacyCovidData
+        return super().find_class(module, name)
+
+
+def legacy_history(legacy):
+    """
+    Flattens a pickled CovidData into a {date: case_data} dict. Handles both the
+    historicalData dict and the older rolling_array/array_index/last_updated
+    layout that data_editor.py used to edit.
+    """
+
+    state = legacy.__dict__
+    history = {}
+
+    rolling = state.get("rolling_array")
+    last_updated = state.get("last_updated")
+    if rolling is not None and last_updated is not None:
+        index = state.get("array_index", len(rolling) - 1)
+        for i, positives in enumerate(rolling):
+            # rolling_array is a ring buffer with today's count at array_index
+            day = last_updated - timedelta(days=(index - i) % len(rolling))
+            history[day] = [int(positives)] + [0] * (FIELDS - 1)
+        if state.get("rpi_array") is not None:
+            history[last_updated] = list(state["rpi_array"])
+
+    history.update(state.get("historicalData", {}))
+    return history
+
+
+def migrate_pickle(pickle_path, store_path):
+    # Under the store's own lock, so a run can't open (and append to) a store
+    # that another run's migration then replaces
+    with state.FileLock(f"{store_path}.lock"):
+        # Another run may have migrated it since the caller looked
+        if not os.path.exists(store_path):
+            with open(pickle_path, "rb") as file:
+                legacy = LegacyUnpickler(file).load()
+            # Built off to the side so a crash can't leave a half-migrated file
+            temp_path = f"{store_path}.tmp"
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            store = TimeSeriesStore(temp_path)
+            store.replace_all(legacy_history(legacy))
+            store.close()
+            os.replace(temp_path, store_path)
+            os.remove(f"{temp_path}.lock")
+    return TimeSeriesStore(store_path)
@@ -0,0 +1,365 @@
+"""
+Copyright (C) 2021 John C. Allwein 'johnnyapol' (admin@johnnyapol.me)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+USER_AGENT = "RPICovidScraper https://github.com/johnnyapol/RPICovidScraper"
+# Discord's limits on one webhook message
+MAX_EMBEDS = 10
+MAX_EMBED_DESCRIPTION = 4096
+MAX_EMBED_TOTAL = 6000
+# Webhook rate limit assumed until Discord's headers say otherwise
+DEFAULT_LIMIT = 5
+DEFAULT_WINDOW = 2.0
+# A message is given up on after this many 429s, or as soon as Discord asks
+# for a longer wait than MAX_RETRY_AFTER seconds (global and Cloudflare
+# limits can last an hour)
+MAX_RATE_LIMITED = 5
+MAX_RETRY_AFTER = 60
+# Minimum seconds between requests to the same host (see HostRateLimiter)
+HOST_INTERVAL = 0.1
+
+DeliveryResult = namedtuple(
+    "DeliveryResult", ["url", "status", "attempts", "latency", "error", "message"]
+)
+
+
+def create_session(pool_size=16):
+    # One pooled session shared by every thread making requests (webhook
+    # deliveries, the dashboard and announcement crawls alike)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+class HostRateLimiter:
+    # Spaces out request starts to each host by at least `interval` seconds
+    def __init__(self, interval=HOST_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fetch(url, session=None, limiter=None, retries=3, backoff=0.5, headers=None):
+    # GET with retries (exponential backoff) on connection errors, 429 and 5xx
+    session = requests if session is None else session
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            metrics.count("http_retries")
+        if limiter is not None:
+            limiter.wait(url)
+        try:
+            with metrics.span("fetch"):
+                response = session.get(url, headers=headers, timeout=30)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    return response
+
+
+def retry_after(response):
+    # Discord reports the 429 backoff in the body (seconds), fall back to the header
+    try:
+        return float(response.json()["retry_after"])
+    except:
+        return float(response.headers.get("Retry-After", 1))
+
+
+class RateLimitBucket:
+    """
+    Our side of one webhook's Discord rate limit bucket. acquire() blocks until
+    a request may go out, and update() keeps the count in step with the
+    X-RateLimit-* headers (and 429s) Discord sends back, so a burst of posts
+    is paced instead of running into 429s.
+    """
+
+    def __init__(
+        self, limit=DEFAULT_LIMIT, window=DEFAULT_WINDOW, clock=None, sleep=None
+    ):
+        self.lock = threading.Lock()
+        self.clock = time.monotonic if clock is None else clock
+        self.sleep = time.sleep if sleep is None else sleep
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        # When the bucket refills (clock time), None while nothing is in flight
+        self.reset = None
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                if self.reset is not None and now >= self.reset:
+                    self.remaining = self.limit
+                    self.reset = None
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    if self.reset is None:
+                        self.reset = now + self.window
+                    return
+                delay = self.reset - now
+            metrics.count("rate_limit_waits")
+            self.sleep(delay)
+
+    def update(self, response):
+        headers = response.headers
+        with self.lock:
+            now = self.clock()
+            try:
+                self.limit = int(headers["X-RateLimit-Limit"])
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+                self.reset = now + float(headers["X-RateLimit-Reset-After"])
+            except (KeyError, ValueError):
+                pass
+            if response.status_code == 429:
+                self.remaining = 0
+                self.reset = now + retry_after(response)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(url):
+    # One bucket per webhook, shared by everything in the process that posts to it
+    with _buckets_lock:
+        if url not in _buckets:
+            _buckets[url] = RateLimitBucket()
+        return _buckets[url]
+
+
+def deliver(
+    session,
+    url,
+    payload,
+    files=(),
+    retries=3,
+    backoff=1.0,
+    timeout=30,
+    sleep=None,
+    bucket=None,
+    rate_limit_retries=MAX_RATE_LIMITED,
+):
+    """
+    Posts one (already serialized) message to a single webhook.
+    429s wait out retry_after and don't count against retries, but only
+    rate_limit_retries of them (see MAX_RETRY_AFTER); connection errors and
+    5xx responses are retried with exponential backoff.
+    files is a sequence of (filename, bytes) tuples. With a RateLimitBucket,
+    every attempt waits for it first.
+    """
+
+    sleep = time.sleep if sleep is None else sleep
+    attempts = 0
+    failures = 0
+    limited = 0
+    status = None
+    error = None
+    start = time.perf_counter()
+    while True:
+        attempts += 1
+        if attempts > 1:
+            metrics.count("http_retries")
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            if files:
+                response = session.post(
+                    url,
+                    params={"wait": "true"},
+                    data={"payload_json": payload},
+                    files={
+                        f"files[{i}]": (name, content)
+                        for i, (name, content) in enumerate(files)
+                    },
+                    timeout=timeout,
+                )
+            else:
+                response = session.post(
+                    url,
+                    params={"wait": "true"},
+                    data=payload,
+                    headers={"Content-Type": "application/json"},
+                    timeout=timeout,
+                )
+            status = response.status_code
+            if bucket is not None:
+                bucket.update(response)
+        except requests.RequestException as e:
+            response = None
+            status = None
+            error = repr(e)
+
+        if response is not None and response.ok:
+            try:
+                message = response.json()
+            except ValueError:
+                message = None
+            latency = time.perf_counter() - start
+            return DeliveryResult(url, status, attempts, latency, None, message)
+
+        if status == 429:
+            metrics.count("http_429s")
+            limited += 1
+            wait = retry_after(response)
+            if limited <= rate_limit_retries and wait <= MAX_RETRY_AFTER:
+                # The bucket already knows to hold off until retry_after
+                if bucket is None:
+                    sleep(wait)
+                continue
+
+        if response is not None:
+            error = f"HTTP {status}: {response.text[:200]}"
+        failures += 1
+        # Other 4xx responses won't get better by retrying
+        retryable = response is None or status >= 500
+        if not retryable or failures > retries:
+            latency = time.perf_counter() - start
+            return DeliveryResult(url, status, attempts, latency, error, None)
+        sleep(backoff * 2 ** (failures - 1))
+
+
+def as_url_list(urls):
+    # config.webhooks may be a single URL instead of a list of them
+    return [urls] if isinstance(urls, str) else list(urls)
+
+
+def deliver_all(urls, payload, files=(), session=None, max_workers=8, **kwargs):
+    """
+    Fans one message out to every webhook in urls concurrently. payload is a
+    dict (serialized once here) and files are (filename, bytes) tuples shared by
+    all deliveries. Returns a DeliveryResult per url, in the same order.
+    Without a session, one is made (and closed) for this call.
+    """
+
+    urls = as_url_list(urls)
+    owned = session is None
+    session = create_session(max(max_workers, 1)) if owned else session
+    body = json.dumps(payload)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=max(min(max_workers, len(urls)), 1)
+        ) as pool:
+            return list(
+                pool.map(lambda url: deliver(session, url, body, files, **kwargs), urls)
+            )
+    finally:
+        if owned:
+            session.close()
+
+
+def deliver_in_order(urls, payloads, session=None, max_workers=8, **kwargs):
+    """
+    Posts several messages (dicts) to every webhook in urls: in order to each
+    webhook, with the webhooks handled concurrently, each paced by its
+    get_bucket(). A webhook gets nothing more after its first failed message,
+    so messages never arrive out of order. Returns {url: [DeliveryResult...]}
+    for the messages each webhook was sent; only the last can have failed.
+    Without a session, one is made (and closed) for this call.
+    """
+
+    urls = as_url_list(urls)
+    owned = session is None
+    session = create_session(max(max_workers, 1)) if owned else session
+    bodies = [json.dumps(payload) for payload in payloads]
+
+    def send(url):
+        results = []
+        bucket = get_bucket(url)
+        for body in bodies:
+            results.append(deliver(session, url, body, bucket=bucket, **kwargs))
+            if results[-1].error is not None:
+                break
+        return results
+
+    try:
+        with ThreadPoolExecutor(
+            max_workers=max(min(max_workers, len(urls)), 1)
+        ) as pool:
+            return dict(zip(urls, pool.map(send, urls)))
+    finally:
+        if owned:
+            session.close()
+
+
+def embed_length(embed):
+    # What Discord counts against MAX_EMBED_TOTAL
+    fields = embed.get("fields", [])
+    return sum(
+        [
+            len(embed.get("title", "")),
+            len(embed.get("description", "")),
+            len(embed.get("footer", {}).get("text", "")),
+            len(embed.get("author", {}).get("name", "")),
+        ]
+        + [len(field["name"]) + len(field["value"]) for field in fields]
+    )
+
+
+def batch_embeds(embeds):
+    # Packs embeds, keeping their order, into as few messages as Discord allows
+    batches = []
+    size = 0
+    for embed in embeds:
+        length = embed_length(embed)
+        full = batches and (
+            len(batches[-1]) == MAX_EMBEDS or size + length > MAX_EMBED_TOTAL
+        )
+        if not batches or full:
+            batches.append([])
+            size = 0
+        batches[-1].append(embed)
+        size += length
+    return batches
+
+
+def edit_message(session, url, message_id, payload, timeout=30):
+    # PATCHes a message this webhook sent earlier (ids come from ?wait=true posts)
+    response = session.patch(
+        f"{url}/messages/{message_id}", json=payload, timeout=timeout
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def print_results(results):
+    for result in results:
+        outcome = "ok" if result.error is None else f"failed ({result.error})"
+        # Don't leak webhook tokens into logs
+        name = result.url.rsplit("/", 1)[0]
+        print(
+            f"Webhook {name}/...: {outcome} after {result.attempts} attempt(s) in {result.latency:.2f}s"
+        )